@@ -0,0 +1,165 @@
+import io
+import json
+import os
+import tarfile
+import time
+
+import numpy as np
+from numpy.lib import format as npy_format
+
+import timestamps
+
+# One .npy file per column. Timestamps are the stored epoch milliseconds as UTC
+# datetime64[ms]; a missing pressure is -1 and a missing temperature or light NaN.
+COLUMNS = (
+    ("id", "id", np.dtype("<i8")),
+    ("timestamp", "timestamp", np.dtype("<M8[ms]")),
+    ("temperature", "temperature", np.dtype("<f4")),
+    ("light", "light", np.dtype("<f4")),
+    ("pressure", "COALESCE(pressure, -1)", np.dtype("<i1")),
+)
+
+CHUNK_SIZE = 50000
+META_FILE = "meta.json"
+
+
+def count_rows(conn, start, end):
+    return conn.execute("SELECT COUNT(*) FROM sensor_data WHERE timestamp >= ? AND timestamp < ?",
+                        (start, end)).fetchone()[0]
+
+
+def npy_header(dtype, count):
+    header = io.BytesIO()
+    npy_format.write_array_header_1_0(header, {
+        "descr": npy_format.dtype_to_descr(dtype),
+        "fortran_order": False,
+        "shape": (count,),
+    })
+    return header.getvalue()
+
+
+def iter_column(conn, expression, dtype, start, end, count, chunk_size=CHUNK_SIZE):
+    """One column's values in (timestamp, id) order as raw little-endian bytes, a chunk at a time.
+
+    Stops after `count` rows so every column matches the header written for it.
+    """
+    after = (start, 0)
+    remaining = count
+    while remaining > 0:
+        # The cursor's timestamp is also the index lower bound, so each chunk seeks instead of rescanning
+        rows = conn.execute(f"""
+            SELECT timestamp, id, {expression}
+            FROM sensor_data
+            WHERE timestamp >= ? AND timestamp < ? AND (timestamp, id) > (?, ?)
+            ORDER BY timestamp, id
+            LIMIT ?
+        """, (after[0], end, after[0], after[1], min(chunk_size, remaining))).fetchall()
+        if not rows:
+            break
+        after = rows[-1][:2]
+        remaining -= len(rows)
+        yield np.array([row[2] for row in rows], dtype=dtype).tobytes()
+
+
+def _snapshot(conn, start, end):
+    # One read transaction, so every column pass sees the same rows even while readings arrive
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
+    return count_rows(conn, start, end)
+
+
+def _meta(start, end, count, room):
+    return json.dumps({
+        "from": timestamps.format_ms(start),
+        "to": timestamps.format_ms(end),
+        "room": room,
+        "rows": count,
+        "columns": [name for name, _, _ in COLUMNS],
+        "exported_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }, indent=2).encode()
+
+
+def write_archive(conn, directory, start, end, room=None, chunk_size=CHUNK_SIZE):
+    """Writes the readings in [start, end) (epoch ms) to `directory` as one .npy file per column; returns the row count."""
+    os.makedirs(directory, exist_ok=True)
+    try:
+        count = _snapshot(conn, start, end)
+        for name, expression, dtype in COLUMNS:
+            with open(os.path.join(directory, f"{name}.npy"), "wb") as f:
+                f.write(npy_header(dtype, count))
+                for chunk in iter_column(conn, expression, dtype, start, end, count, chunk_size):
+                    f.write(chunk)
+        with open(os.path.join(directory, META_FILE), "wb") as f:
+            f.write(_meta(start, end, count, room))
+    finally:
+        conn.rollback()
+    return count
+
+
+def _tar_member(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.USTAR_FORMAT)
+
+
+def _tar_padding(size):
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def iter_archive_tar(conn, start, end, room=None, chunk_size=CHUNK_SIZE):
+    """The same archive as write_archive, streamed as an uncompressed tar.
+
+    Member sizes are known from the row count up front, so nothing is buffered
+    beyond one chunk. The caller owns `conn` and should roll back when done.
+    """
+    count = _snapshot(conn, start, end)
+    for name, expression, dtype in COLUMNS:
+        header = npy_header(dtype, count)
+        size = len(header) + count * dtype.itemsize
+        yield _tar_member(f"{name}.npy", size)
+        yield header
+        yield from iter_column(conn, expression, dtype, start, end, count, chunk_size)
+        yield _tar_padding(size)
+
+    meta = _meta(start, end, count, room)
+    yield _tar_member(META_FILE, len(meta))
+    yield meta
+    yield _tar_padding(len(meta))
+    yield b"\0" * (2 * tarfile.BLOCKSIZE)
+
+
+def _memmap_member(path, offset):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        npy_format.read_magic(f)
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(f)
+        data_offset = f.tell()
+    if not shape[0]:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=data_offset, shape=shape,
+                     order="F" if fortran_order else "C")
+
+
+def load_archive(path):
+    """Memory-maps an exported archive, a directory or a downloaded .tar, into {column: array, "meta": dict}.
+
+    Nothing is read until the arrays are used, so months of readings open instantly.
+    """
+    archive = {}
+    if os.path.isdir(path):
+        for name, _, _ in COLUMNS:
+            archive[name] = _memmap_member(os.path.join(path, f"{name}.npy"), 0)
+        with open(os.path.join(path, META_FILE)) as f:
+            archive["meta"] = json.load(f)
+        return archive
+
+    with tarfile.open(path) as tar:
+        for member in tar.getmembers():
+            if member.name.endswith(".npy"):
+                # Tar stores members uncompressed and contiguous, so they can be mapped in place
+                archive[member.name[:-len(".npy")]] = _memmap_member(path, member.offset_data)
+            elif member.name == META_FILE:
+                archive["meta"] = json.load(tar.extractfile(member))
+    return archive
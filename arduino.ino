@@ -20,8 +20,15 @@ const unsigned long SLEEP_DURATION = 15000;  // 8 hours in milliseconds (8 * 60
 bool sleepTimerActive = false;
 
 const unsigned long SEND_INTERVAL = 2000;  // Send data every 5 seconds
+// Binary records are ~13 bytes instead of ~35 characters, so we can sample more often
+const unsigned long BINARY_SEND_INTERVAL = 500;
 unsigned long lastSendTime = 0;
 
+// Set when the client sends "MODE:BIN"; see serial_protocol.py for the record layout
+bool binaryMode = false;
+uint16_t frameSequence = 0;
+const uint8_t FRAME_SIZE = 13;
+
 int buttonState2 = 0; 
 int buttonState4 = 0; 
 
@@ -33,6 +40,8 @@ int servoPin = 7; // Connect the servo signal wire to pin 9
 
 void setup() {
   Serial.begin(9600);
+  // Don't let a partial command from the client stall sampling for the default second
+  Serial.setTimeout(50);
 
   // put your setup code here, to run once:
   pinMode(PIN_RED,   OUTPUT);
@@ -81,7 +90,7 @@ void loop() {
 
   //Send data to client
   unsigned long currentTime = millis();
-  if (currentTime - lastSendTime >= SEND_INTERVAL) {
+  if (currentTime - lastSendTime >= (binaryMode ? BINARY_SEND_INTERVAL : SEND_INTERVAL)) {
     sendSensorData(light,temp,pressure);
     lastSendTime = currentTime;
   }
@@ -90,8 +99,15 @@ void loop() {
 void checkServerChanges() {
   if (Serial.available() > 0) {
     String command = Serial.readStringUntil('\n');
+    command.trim();
     if (command.startsWith("PREFS:")) {
       handlePreferences(command);
+    } else if (command == "MODE:BIN") {
+      Serial.println("ACK:BIN");
+      binaryMode = true;
+      frameSequence = 0;
+    } else if (command == "MODE:TEXT") {
+      binaryMode = false;
     }
   }
 }
@@ -152,6 +168,11 @@ void controlLight(int currentLight) {
 }
 
 void sendSensorData(float light, float temp, int pressure){
+  if (binaryMode) {
+    sendSensorFrame(light, temp, pressure);
+    return;
+  }
+
   //Send data to serial
   Serial.print("temp:");
   Serial.print(temp);
@@ -161,6 +182,41 @@ void sendSensorData(float light, float temp, int pressure){
   Serial.println(pressure);
 }
 
+void sendSensorFrame(float light, float temp, int pressure) {
+  // Little-endian: sync, sequence, millis, temperature * 100, light, pressure, CRC-8
+  uint8_t frame[FRAME_SIZE];
+  uint16_t sequence = frameSequence++;
+  unsigned long now = millis();
+  int16_t centiTemp = (int16_t) round(temp * 100);
+
+  frame[0] = 0xAA;
+  frame[1] = 0x55;
+  frame[2] = sequence & 0xFF;
+  frame[3] = sequence >> 8;
+  frame[4] = now & 0xFF;
+  frame[5] = (now >> 8) & 0xFF;
+  frame[6] = (now >> 16) & 0xFF;
+  frame[7] = (now >> 24) & 0xFF;
+  frame[8] = centiTemp & 0xFF;
+  frame[9] = (centiTemp >> 8) & 0xFF;
+  frame[10] = (uint8_t) constrain(light, 0, 255);
+  frame[11] = pressure;
+  frame[12] = crc8(frame + 2, FRAME_SIZE - 3);
+  Serial.write(frame, FRAME_SIZE);
+}
+
+uint8_t crc8(const uint8_t *data, uint8_t length) {
+  // CRC-8, polynomial 0x07
+  uint8_t crc = 0;
+  for (uint8_t i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
+
 
 void changeLEDColor(int red, int green, int blue) {
   analogWrite(PIN_RED,   red);
@@ -202,8 +258,10 @@ void readBedSensor() {
       (currentButtonState4 == LOW && lastButtonState4 == HIGH)) {
     if (currentTime - lastDebounceTime > debounceDelay) {
       isSleeping = !isSleeping;
-      Serial.print("isSleeping: ");
-      Serial.println(isSleeping);
+      if (!binaryMode) {
+        Serial.print("isSleeping: ");
+        Serial.println(isSleeping);
+      }
       lastDebounceTime = currentTime;
     }
   }
@@ -1,11 +1,45 @@
+import argparse
+import json
+import os
+import queue
 import serial
 import requests
+import threading
 import time
 
-SERIAL_PORT = "/dev/ttyACM0" 
+import serial_protocol
+
+SERIAL_PORT = "/dev/ttyACM0"
 BAUD_RATE = 9600
-FLASK_API_URL = "http://127.0.0.1:5000/api/sensor-data"
-PREFERENCES_API_URL = "http://127.0.0.1:5000/api/preferences"
+SERVER_URL = "http://127.0.0.1:5000"
+
+def api_urls(server_url):
+    return (server_url + "/api/sensor-data", server_url + "/api/sensor-data/batch",
+            server_url + "/api/preferences/changes")
+
+FLASK_API_URL, FLASK_BATCH_API_URL, PREFERENCES_CHANGES_API_URL = api_urls(SERVER_URL)
+
+# Batch mode: flush buffered readings once we have this many or the oldest is this old
+BATCH_SIZE = 20
+BATCH_MAX_AGE = 10  # seconds
+
+# Readings waiting between the serial reader and the HTTP sender
+QUEUE_SIZE = 1000
+# Readings the server couldn't take are kept here and replayed later
+SPOOL_PATH = "client_spool.jsonl"
+SPOOL_RETRY_INTERVAL = 15  # seconds
+HTTP_TIMEOUT = 5  # seconds
+# How long the server may hold a preferences long-poll open
+PREFERENCES_WAIT_TIMEOUT = 30  # seconds
+PREFERENCES_RETRY_INTERVAL = 5  # seconds
+
+# How long to wait for the sketch to accept binary framing before falling back to text
+BINARY_NEGOTIATION_TIMEOUT = 3  # seconds
+
+# Keep-alive connection shared by every request the sender makes
+http = requests.Session()
+# The preferences long-poll gets its own so it never holds up readings
+prefs_http = requests.Session()
 
 def parse_data(data):
     try:
@@ -21,85 +55,386 @@ def parse_data(data):
 
 def send_to_flask(data):
     try:
-        response = requests.post(FLASK_API_URL, json=data)
+        response = http.post(FLASK_API_URL, json=data, timeout=HTTP_TIMEOUT)
         print(f"Sent data: {data}, Response: {response.status_code}")
+        # 202 means the server queued it for its write-behind writer
+        return response.status_code in (200, 202)
     except requests.exceptions.RequestException as e:
         print(f"Error sending data to Flask: {e}")
+        return False
+
+def post_batch(readings):
+    """Posts readings to the batch endpoint; returns the response status, or None if the server wasn't reached."""
+    try:
+        response = http.post(FLASK_BATCH_API_URL, json=readings, timeout=HTTP_TIMEOUT)
+        print(f"Sent batch of {len(readings)} readings, Response: {response.status_code}")
+        return response.status_code
+    except requests.exceptions.RequestException as e:
+        print(f"Error sending batch to Flask: {e}")
+        return None
+
+def send_batch_to_flask(readings):
+    return post_batch(readings) in (200, 202)
+
+def is_rejected(status):
+    # The server refused the readings themselves, so sending them again won't help
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+class Spool:
+    """Append-only file of readings that could not be delivered, one JSON object per line.
+
+    Readings the server rejects outright are moved to a `.rejected` file next to it, so
+    they can be looked at without holding up the rest.
+    """
+
+    def __init__(self, path=SPOOL_PATH):
+        self.path = path
+        self.replaying_path = path + ".replaying"
+        self.rejected_path = path + ".rejected"
+        self.lock = threading.Lock()
+
+    def append(self, readings, path=None):
+        with self.lock, open(path or self.path, "a") as f:
+            for reading in readings:
+                f.write(json.dumps(reading) + "\n")
+
+    def has_data(self):
+        return any(os.path.exists(path) and os.path.getsize(path) > 0 for path in (self.path, self.replaying_path))
+
+    def replay(self, chunk_size=BATCH_SIZE * 10):
+        """Sends spooled readings through the batch endpoint, keeping whatever is still undelivered.
+
+        The file is moved aside under the lock and sent without it, so the reader thread
+        can keep spooling while the server is slow. Only one thread may replay.
+        """
+        with self.lock:
+            # A replay interrupted by a crash left its readings in the replaying file
+            if not os.path.exists(self.replaying_path):
+                if not self.has_data():
+                    return True
+                os.replace(self.path, self.replaying_path)
+        with open(self.replaying_path) as f:
+            readings = [json.loads(line) for line in f if line.strip()]
+        # Readings spooled by the reader on overflow can be newer than ones spooled after them
+        readings.sort(key=lambda reading: reading.get("timestamp") or 0)
+
+        sent = rejected = 0
+        while sent < len(readings):
+            chunk = readings[sent:sent + chunk_size]
+            status = post_batch(chunk)
+            if is_rejected(status):
+                self.append(chunk, self.rejected_path)
+                rejected += len(chunk)
+            elif status not in (200, 202):
+                break
+            sent += chunk_size
+
+        with self.lock:
+            # Readings spooled meanwhile are newer, so they go after the ones still undelivered
+            unsent = [json.dumps(reading) + "\n" for reading in readings[sent:]]
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    unsent.extend(line for line in f if line.strip())
+            with open(self.path + ".tmp", "w") as f:
+                f.writelines(unsent)
+            os.replace(self.path + ".tmp", self.path)
+            os.remove(self.replaying_path)
+        print(f"Replayed {min(sent, len(readings)) - rejected} of {len(readings)} spooled readings")
+        if rejected:
+            print(f"The server rejected {rejected} spooled readings; moved them to {self.rejected_path}")
+        return sent >= len(readings)
+
+class ReadingBuffer:
+    """Accumulates timestamped readings and sends them to the batch endpoint."""
+
+    def __init__(self, spool, max_size=BATCH_SIZE, max_age=BATCH_MAX_AGE):
+        self.spool = spool
+        self.max_size = max_size
+        self.max_age = max_age
+        self.readings = []
+
+    def add(self, data):
+        self.readings.append(data)
+
+    def is_due(self):
+        if not self.readings:
+            return False
+        oldest = self.readings[0]["timestamp"]
+        return len(self.readings) >= self.max_size or time.time() - oldest >= self.max_age
+
+    def flush(self):
+        if not self.readings:
+            return True
+        # Behind readings still spooled, these wait their turn so the server gets them in time order
+        ok = not self.spool.has_data() and send_batch_to_flask(self.readings)
+        if not ok:
+            self.spool.append(self.readings)
+        self.readings = []
+        return ok
+
+def wire_time(size):
+    # 8N1 framing: 10 bits on the wire per byte
+    return size * 10 / BAUD_RATE
+
+class BoardClock:
+    """Maps the board's millis() onto our clock to get each record's capture time.
+
+    The offset between the clocks is the smallest one seen, i.e. the record that waited
+    least in buffers, so queuing never pushes capture times later. It may creep up by
+    MAX_DRIFT per second to follow a slow board oscillator.
+    """
+
+    MAX_DRIFT = 0.001
+
+    def __init__(self):
+        self.offset = None
+        self.last_millis = None
+        self.wraps = 0
+
+    def capture_time(self, millis, arrival):
+        if self.last_millis is not None and millis < self.last_millis:
+            if self.last_millis - millis > 2 ** 31:
+                self.wraps += 1  # millis() wraps after ~49 days
+            else:
+                self.offset, self.wraps = None, 0  # the board was reset
+        elapsed = 0 if self.offset is None else (millis - self.last_millis) % 2 ** 32 / 1000
+        self.last_millis = millis
 
-def get_user_preferences():
+        board_time = (millis + self.wraps * 2 ** 32) / 1000
+        offset = arrival - board_time
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+        else:
+            self.offset = min(offset, self.offset + elapsed * self.MAX_DRIFT)
+        return board_time + self.offset
+
+def queue_reading(readings, spool, data, overflow, room, captured):
+    """Stamps a reading with its capture time and hands it to the sender, never blocking the serial port."""
+    data["timestamp"] = captured
+    if room:
+        data["room"] = room
+
+    try:
+        readings.put_nowait(data)
+        return 0
+    except queue.Full:
+        # The sender is falling behind
+        if overflow == "spool":
+            spool.append([data])
+            return 0
+        try:
+            readings.get_nowait()
+        except queue.Empty:
+            pass
+        readings.put_nowait(data)
+        return 1
+
+def read_serial(ser, readings, spool, stop, overflow="spool", room=None):
+    """Reader stage: turns serial lines into timestamped readings as fast as they arrive.
+
+    Reads whatever bytes are waiting rather than a line at a time, so a line is handled
+    the moment its newline comes in. Its capture time is when its last byte arrived,
+    minus the time the line spent on the wire.
+    """
+    dropped = 0
+    pending = bytearray()
+    while not stop.is_set():
+        # Returns as soon as at least one byte is available, or after the port timeout
+        chunk = ser.read(ser.in_waiting or 1)
+        arrival = time.time()
+        if not chunk:
+            continue
+        pending += chunk
+
+        while b"\n" in pending:
+            line, _, rest = pending.partition(b"\n")
+            pending = bytearray(rest)
+            raw_data = line.decode("utf-8", errors="replace").strip()
+            if not raw_data:
+                continue
+            print(f"Received: {raw_data}")
+
+            # Check if it's a data line (not a control acknowledgment)
+            if not (raw_data.startswith("temp:") or raw_data.startswith("light:") or raw_data.startswith("pressure:")):
+                continue
+            parsed_data = parse_data(raw_data)
+            if not parsed_data:
+                continue
+
+            captured = arrival - wire_time(len(line) + 1 + len(pending))
+            if queue_reading(readings, spool, parsed_data, overflow, room, captured):
+                dropped += 1
+                print(f"Send queue full, dropped {dropped} readings so far")
+
+def negotiate_binary(ser, timeout=BINARY_NEGOTIATION_TIMEOUT):
+    """Asks the sketch to switch to binary frames; False if it doesn't acknowledge (older sketch)."""
+    ser.reset_input_buffer()
+    ser.write(serial_protocol.BINARY_REQUEST)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        line = ser.readline().decode("utf-8", errors="replace").strip()
+        if line == serial_protocol.BINARY_ACK:
+            return True
+    return False
+
+def read_serial_binary(ser, readings, spool, stop, overflow="spool", room=None):
+    """Reader stage for binary framing: decodes checksummed records and reports lost or corrupted ones.
+
+    Capture times come from the millis() the board stamps on each record.
+    """
+    decoder = serial_protocol.FrameDecoder()
+    clock = BoardClock()
+    dropped = lost = corrupted = 0
+    while not stop.is_set():
+        chunk = ser.read(ser.in_waiting or 1)
+        arrival = time.time() - wire_time(serial_protocol.FRAME.size)
+        if not chunk:
+            continue
+
+        for reading in decoder.feed(chunk):
+            data = {"temp": reading["temp"], "light": reading["light"], "pressure": reading["pressure"]}
+            captured = clock.capture_time(reading["millis"], arrival)
+            if queue_reading(readings, spool, data, overflow, room, captured):
+                dropped += 1
+                print(f"Send queue full, dropped {dropped} readings so far")
+
+        if (decoder.dropped, decoder.corrupted) != (lost, corrupted):
+            lost, corrupted = decoder.dropped, decoder.corrupted
+            print(f"Serial link: {decoder.received} records received, {lost} lost, {corrupted} corrupted")
+
+def send_readings(readings, spool, stop, buffer=None):
+    """Sender stage: drains the queue to the server and spools what it can't deliver."""
+    last_replay = 0
+    while not (stop.is_set() and readings.empty()):
+        try:
+            data = readings.get(timeout=1)
+        except queue.Empty:
+            data = None
+
+        if data is not None and buffer is not None:
+            buffer.add(data)
+        elif data is not None and (spool.has_data() or not send_to_flask(data)):
+            # Spooled readings go first, so the server sees readings in time order
+            spool.append([data])
+
+        if buffer is not None and buffer.is_due():
+            buffer.flush()
+
+        current_time = time.time()
+        if current_time - last_replay >= SPOOL_RETRY_INTERVAL and spool.has_data():
+            # Once the server takes readings again, drain everything spooled in the meantime too
+            while spool.replay() and spool.has_data():
+                pass
+            last_replay = current_time
+
+    if buffer is not None:
+        buffer.flush()
+
+def wait_for_preference_changes(version, room=None):
+    """Long-polls the server until the preferences version moves past `version`; None on timeout or error."""
+    params = {"version": version, "timeout": PREFERENCES_WAIT_TIMEOUT}
+    if room:
+        params["room"] = room
     try:
-        response = requests.get(PREFERENCES_API_URL)
+        response = prefs_http.get(PREFERENCES_CHANGES_API_URL, params=params,
+                                  timeout=PREFERENCES_WAIT_TIMEOUT + HTTP_TIMEOUT)
         if response.status_code == 200:
             prefs = response.json()
             print(f"Got user preferences: {prefs}")
             return prefs
-        else:
+        if response.status_code != 304:
             print(f"Error getting user preferences: {response.status_code}")
-            return None
+            time.sleep(PREFERENCES_RETRY_INTERVAL)
+        return None
     except requests.exceptions.RequestException as e:
         print(f"Error connecting to preferences API: {e}")
+        time.sleep(PREFERENCES_RETRY_INTERVAL)
         return None
 
+def format_preferences_command(prefs):
+    # Format: "PREFS:ideal_temp,max_light,adaptive_light,auto_temp"
+    # Where adaptive_light and auto_temp are 1 (true) or 0 (false)
+    adaptive_light = 1 if prefs.get("adaptive_light", False) else 0
+    auto_temp = 1 if prefs.get("auto_temp", False) else 0
+    return f"PREFS:{prefs.get('ideal_temp', 18.5)},{prefs.get('max_light', 10)},{adaptive_light},{auto_temp}\n"
+
 def send_preferences_to_arduino(ser, prefs):
     if not prefs:
         return False
-    
+
     try:
-        # Format: "PREFS:ideal_temp,max_light,adaptive_light,auto_temp"
-        # Where adaptive_light and auto_temp are 1 (true) or 0 (false)
-        adaptive_light = 1 if prefs.get("adaptive_light", False) else 0
-        auto_temp = 1 if prefs.get("auto_temp", False) else 0
-        
-        command_str = f"PREFS:{prefs.get('ideal_temp', 18.5)},{prefs.get('max_light', 10)},{adaptive_light},{auto_temp}\n"
-        
+        command_str = format_preferences_command(prefs)
+
         print(f"Sending preferences to Arduino: {command_str.strip()}")
         ser.write(command_str.encode())
-        
-        return False
-    
+
+        return True
+
     except Exception as e:
         print(f"Error sending preferences to Arduino: {e}")
         return False
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forwards Arduino sensor readings to the Flask server.")
+    parser.add_argument("--port", default=SERIAL_PORT, help="serial port the Arduino is connected to")
+    parser.add_argument("--server", default=SERVER_URL, help="base URL of the Flask server (default: %(default)s)")
+    parser.add_argument("--batch", action="store_true", help="buffer readings and send them in batches")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--batch-max-age", type=float, default=BATCH_MAX_AGE)
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    parser.add_argument("--on-full", choices=["spool", "drop-oldest"], default="spool",
+                        help="what to do with new readings when the send queue is full")
+    parser.add_argument("--spool", default=SPOOL_PATH, help="file for readings the server could not take")
+    parser.add_argument("--room", help="bedroom this device is in (default: the server's default room)")
+    parser.add_argument("--binary", action="store_true",
+                        help="ask the Arduino for compact checksummed binary records instead of text lines")
+    args = parser.parse_args()
+    FLASK_API_URL, FLASK_BATCH_API_URL, PREFERENCES_CHANGES_API_URL = api_urls(args.server.rstrip("/"))
+
+    spool = Spool(args.spool)
+    buffer = ReadingBuffer(spool, args.batch_size, args.batch_max_age) if args.batch else None
+    readings = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
+    sender = None
+
     try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
+        ser = serial.Serial(args.port, BAUD_RATE, timeout=1)
         time.sleep(2)
         print("Connected to Arduino. Starting communication...")
-        
-        last_prefs_check = 0
-        prefs_check_interval = 10 
 
-        prefs = get_user_preferences()
-        if prefs:
-            send_preferences_to_arduino(ser, prefs)
-        else:
-            print("No preferences found. Skipping sending to Arduino.")
-        
+        read = read_serial
+        if args.binary:
+            if negotiate_binary(ser):
+                print("Arduino switched to binary framing")
+                read = read_serial_binary
+            else:
+                print("Arduino did not acknowledge binary framing, staying on text")
+
+        reader = threading.Thread(target=read, args=(ser, readings, spool, stop, args.on_full, args.room), daemon=True)
+        sender = threading.Thread(target=send_readings, args=(readings, spool, stop, buffer))
+        reader.start()
+        sender.start()
+
+        # The main thread only keeps the Arduino's preferences up to date. It waits on the
+        # server for changes and writes to the board only when the values it uses differ.
+        prefs_version = 0
+        last_command = None
         while True:
-            # Read data from Arduino
-            raw_data = ser.readline().decode("utf-8").strip()
-            if raw_data:
-                print(f"Received: {raw_data}")
-                
-                # Check if it's a data line (not a control acknowledgment)
-                if raw_data.startswith("temp:") or raw_data.startswith("light:") or raw_data.startswith("pressure:"):
-                    parsed_data = parse_data(raw_data)
-                    if parsed_data:
-                        send_to_flask(parsed_data)
-
-            current_time = time.time()
-            if current_time - last_prefs_check >= prefs_check_interval:
-                prefs = get_user_preferences()
-                if prefs:
-                    send_preferences_to_arduino(ser, prefs)
-                else:
-                    print("No preferences found. Skipping sending to Arduino.")
-                last_prefs_check = current_time     
+            prefs = wait_for_preference_changes(prefs_version, args.room)
+            if not prefs:
+                continue
+            prefs_version = prefs.get("version", prefs_version)
             
-            time.sleep(1)
-
+            command = format_preferences_command(prefs)
+            if command != last_command and send_preferences_to_arduino(ser, prefs):
+                last_command = command
 
     except serial.SerialException as e:
-        print(f"Serial connection error: {e}")
\ No newline at end of file
+        print(f"Serial connection error: {e}")
+    except KeyboardInterrupt:
+        print("Stopping...")
+    finally:
+        stop.set()
+        if sender is not None:
+            sender.join()
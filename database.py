@@ -0,0 +1,516 @@
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import metrics
+import rollups
+import scoring
+import sessions
+import summaries
+import timestamps
+
+DB_PATH = os.environ.get("SMART_BEDROOM_DB", "smart_bedroom.db")
+# Rooms other than this one get their own database file next to DB_PATH
+DEFAULT_ROOM = "default"
+POOL_SIZE = int(os.environ.get("SMART_BEDROOM_DB_POOL_SIZE", 8))
+
+# Pragmas applied to every connection we hand out
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",  # only takes effect on a new file; lets retention give space back
+    "PRAGMA journal_mode=WAL",       # readers never block behind the writer
+    "PRAGMA synchronous=NORMAL",     # fsync on checkpoint only, safe with WAL
+    "PRAGMA cache_size=-16000",      # ~16MB page cache per connection
+    "PRAGMA mmap_size=268435456",    # map up to 256MB of the file
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+# Datetimes bound as parameters are stored as epoch milliseconds; registered once for the whole process
+sqlite3.register_adapter(datetime, timestamps.to_ms)
+
+# How times were stored before migration 11: local wall-clock text
+TEXT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _create_base_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sensor_data (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        temperature REAL,
+                        light REAL,
+                        pressure INTEGER,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sleep_sessions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        start_time DATETIME,
+                        end_time DATETIME,
+                        duration_minutes INTEGER,
+                        avg_temperature REAL,
+                        avg_light REAL,
+                        quality TEXT)''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS user_preferences (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        ideal_temp REAL DEFAULT 18.5,
+                        max_light INTEGER DEFAULT 50,
+                        adaptive_light BOOLEAN DEFAULT 1,
+                        auto_temp BOOLEAN DEFAULT 1,
+                        sleep_notifications BOOLEAN DEFAULT 1,
+                        sound_id TEXT DEFAULT 'white-noise',
+                        sound_duration INTEGER DEFAULT 30)''')
+
+    # Insert default preferences if not exists
+    cursor.execute("SELECT COUNT(*) FROM user_preferences")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("INSERT INTO user_preferences DEFAULT VALUES")
+
+
+def _add_column_if_missing(cursor, table, column, definition):
+    # Databases created before versioning may already have the column
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _add_session_aggregates(cursor):
+    # Running sums and extremes maintained while a session is open
+    for column, definition in (
+        ("sample_count", "INTEGER DEFAULT 0"),
+        ("temp_sum", "REAL DEFAULT 0"),
+        ("light_sum", "REAL DEFAULT 0"),
+        ("min_temperature", "REAL"),
+        ("max_temperature", "REAL"),
+        ("min_light", "REAL"),
+        ("max_light", "REAL"),
+    ):
+        _add_column_if_missing(cursor, "sleep_sessions", column, definition)
+
+
+def _add_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sensor_data_timestamp ON sensor_data(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sleep_sessions_start_time ON sleep_sessions(start_time)")
+    # Only the open session is indexed, so the per-sample lookup stays a single-entry probe
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sleep_sessions_active ON sleep_sessions(start_time) WHERE end_time IS NULL")
+
+
+def _add_preferences_version(cursor):
+    # Bumped on every preferences change so clients can wait for the next one
+    _add_column_if_missing(cursor, "user_preferences", "version", "INTEGER DEFAULT 1")
+
+
+# Steps 5, 7 and 9 below keep the SQL they were applied with, which reads the text times
+# stored before migration 11; later changes to the rollups and summaries go in new steps
+_TEXT_ROLLUPS = (
+    ("sensor_rollup_minute", "%Y-%m-%d %H:%M:00"),
+    ("sensor_rollup_hour", "%Y-%m-%d %H:00:00"),
+)
+_TEXT_ROLLUP_METRICS = ("temperature", "light", "pressure")
+
+
+def _create_rollup_tables(cursor):
+    # Per-minute and per-hour aggregates of sensor_data, filled as readings are ingested
+    for table, _ in _TEXT_ROLLUPS:
+        columns = ",\n".join(
+            f"{metric}_sum REAL DEFAULT 0, {metric}_min REAL, {metric}_max REAL" for metric in _TEXT_ROLLUP_METRICS
+        )
+        cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                            bucket TEXT PRIMARY KEY,
+                            sample_count INTEGER DEFAULT 0,
+                            {columns})''')
+
+    # Highest sensor_data id already folded into the rollups
+    cursor.execute("CREATE TABLE IF NOT EXISTS rollup_watermark (last_id INTEGER NOT NULL)")
+    cursor.execute("SELECT COUNT(*) FROM rollup_watermark")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("INSERT INTO rollup_watermark (last_id) VALUES (0)")
+
+    # Existing rows are rolled up here, new ones as they are ingested
+    last_id = cursor.execute("SELECT last_id FROM rollup_watermark").fetchone()[0]
+    new_last_id = cursor.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0]
+    if new_last_id is None or new_last_id <= last_id:
+        return
+    aggregates = ", ".join(f"TOTAL({metric}), MIN({metric}), MAX({metric})" for metric in _TEXT_ROLLUP_METRICS)
+    columns = ", ".join(f"{metric}_sum, {metric}_min, {metric}_max" for metric in _TEXT_ROLLUP_METRICS)
+    merges = ",\n".join(
+        f"{metric}_sum = {metric}_sum + excluded.{metric}_sum, "
+        f"{metric}_min = MIN(COALESCE({metric}_min, excluded.{metric}_min), COALESCE(excluded.{metric}_min, {metric}_min)), "
+        f"{metric}_max = MAX(COALESCE({metric}_max, excluded.{metric}_max), COALESCE(excluded.{metric}_max, {metric}_max))"
+        for metric in _TEXT_ROLLUP_METRICS
+    )
+    for table, bucket_format in _TEXT_ROLLUPS:
+        cursor.execute(f"""
+            INSERT INTO {table} (bucket, sample_count, {columns})
+            SELECT strftime('{bucket_format}', timestamp), COUNT(*), {aggregates}
+            FROM sensor_data WHERE id > ? AND id <= ?
+            GROUP BY 1
+            ON CONFLICT(bucket) DO UPDATE SET
+                sample_count = sample_count + excluded.sample_count,
+                {merges}
+        """, (last_id, new_last_id))
+    cursor.execute("UPDATE rollup_watermark SET last_id = ?", (new_last_id,))
+
+
+def _refresh_text_day(conn, date):
+    # summaries.refresh_day as it was while times were "%Y-%m-%d %H:%M:%S" text
+    rows = conn.execute("""
+        SELECT start_time, end_time, duration_minutes, avg_temperature, avg_light, quality
+        FROM sleep_sessions
+        WHERE start_time >= ? AND start_time < date(?, '+1 day') AND end_time IS NOT NULL
+        ORDER BY start_time DESC
+    """, (date, date)).fetchall()
+
+    if not rows:
+        conn.execute("DELETE FROM daily_sleep_summary WHERE date = ?", (date,))
+        return
+
+    entries = [{
+        "date": start_time[:10],
+        "start_time": start_time[11:16],
+        "end_time": end_time[11:16],
+        "hours": round((duration_minutes or 0) / 60, 1),
+        "temp": avg_temperature,
+        "light": avg_light,
+        "quality": quality
+    } for start_time, end_time, duration_minutes, avg_temperature, avg_light, quality in rows]
+    temps = [row[3] for row in rows if row[3] is not None]
+    lights = [row[4] for row in rows if row[4] is not None]
+    conn.execute("""
+        INSERT OR REPLACE INTO daily_sleep_summary
+        (date, session_count, total_minutes, temp_sum, temp_count, light_sum, light_count, sessions)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (date, len(rows), sum(row[2] or 0 for row in rows), sum(temps), len(temps), sum(lights), len(lights),
+          json.dumps(entries)))
+
+
+def _create_daily_summaries(cursor):
+    # One row per night of finished sleep sessions; see summaries.py
+    cursor.execute('''CREATE TABLE IF NOT EXISTS daily_sleep_summary (
+                        date TEXT PRIMARY KEY,
+                        session_count INTEGER NOT NULL,
+                        total_minutes REAL NOT NULL,
+                        temp_sum REAL NOT NULL,
+                        temp_count INTEGER NOT NULL,
+                        light_sum REAL NOT NULL,
+                        light_count INTEGER NOT NULL,
+                        sessions TEXT NOT NULL)''')
+
+    # Existing sessions are summarised here, new ones as they end
+    cursor.execute("DELETE FROM daily_sleep_summary")
+    dates = cursor.execute("SELECT DISTINCT date(start_time) FROM sleep_sessions WHERE end_time IS NOT NULL").fetchall()
+    for (date,) in dates:
+        _refresh_text_day(cursor.connection, date)
+
+
+def _create_rooms_table(cursor):
+    # Registry of known rooms, kept in the main database
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rooms (
+                        name TEXT PRIMARY KEY,
+                        created_at DATETIME)''')
+
+
+def _create_worker_state(cursor):
+    # One row through which server worker processes sharing this file see each other's
+    # session detector, summary changes and scoring overrides
+    cursor.execute('''CREATE TABLE IF NOT EXISTS worker_state (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        detector_version INTEGER DEFAULT 0,
+                        detector TEXT,
+                        last_reading_id INTEGER,
+                        summaries_version INTEGER DEFAULT 0,
+                        scoring_thresholds TEXT)''')
+    cursor.execute("INSERT OR IGNORE INTO worker_state (id) VALUES (1)")
+
+
+def _add_open_session_guard(cursor):
+    # Concurrent writers could leave several sessions open; keep the newest and close
+    # each older one where the next began, so at most one can be open from now on
+    conn = cursor.connection
+    open_sessions = cursor.execute("""
+        SELECT id, start_time, sample_count, temp_sum, light_sum FROM sleep_sessions
+        WHERE end_time IS NULL ORDER BY start_time, id
+    """).fetchall()
+    for (session_id, start_time, sample_count, temp_sum, light_sum), following in zip(open_sessions, open_sessions[1:]):
+        end_time = following[1]
+        duration = (datetime.strptime(end_time, TEXT_TIME_FORMAT) - datetime.strptime(start_time, TEXT_TIME_FORMAT)).total_seconds() * sessions.DURATION_SCALE
+        avg_temp, avg_light = sessions.session_averages(sample_count, temp_sum, light_sum)
+        quality = scoring.UNKNOWN if avg_temp is None else scoring.determine_sleep_quality(avg_temp, avg_light, duration)
+        cursor.execute("""
+            UPDATE sleep_sessions SET end_time = ?, duration_minutes = ?, avg_temperature = ?, avg_light = ?, quality = ?
+            WHERE id = ?
+        """, (end_time, round(duration), avg_temp, avg_light, quality, session_id))
+        _refresh_text_day(conn, start_time[:10])
+        summaries.mark_changed(conn)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sleep_sessions_one_open ON sleep_sessions((end_time IS NULL)) WHERE end_time IS NULL")
+
+
+
+def _add_rollup_time_weights(cursor):
+    # Buckets rolled up before this keep their plain averages
+    for table, _ in rollups.ROLLUPS:
+        for column, definition in rollups.WEIGHT_COLUMNS:
+            _add_column_if_missing(cursor, table, column, definition)
+
+
+
+def _text_to_ms(column):
+    # SQLite's 'utc' modifier reads the text as local time, like the server wrote it
+    return (f"CASE WHEN typeof({column}) = 'text' "
+            f"THEN CAST(ROUND((julianday({column}, 'utc') - 2440587.5) * 86400000) AS INTEGER) ELSE {column} END")
+
+
+def _convert_table(cursor, table, create, time_columns, indexes=()):
+    """Recreates `table` from `create` (a CREATE TABLE with a {table} placeholder), turning `time_columns` into epoch ms."""
+    old_columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+    cursor.execute(create.format(table=f"{table}_new"))
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table}_new)").fetchall() if row[1] in old_columns]
+    select = ", ".join(_text_to_ms(column) if column in time_columns else column for column in columns)
+    cursor.execute(f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {select} FROM {table}")
+
+    # Keeps AUTOINCREMENT from reusing the ids of rows deleted at the end of the old table
+    sequence = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    if sequence:
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+    for index in indexes:
+        cursor.execute(index)
+
+
+def _store_epoch_ms(cursor):
+    # Every stored time becomes integer epoch milliseconds (UTC): smaller indexes, integer
+    # range scans, sub-second readings and no text parsing; the API still speaks local time
+    conn = cursor.connection
+    _convert_table(cursor, "sensor_data", '''CREATE TABLE {table} (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        temperature REAL,
+                        light REAL,
+                        pressure INTEGER,
+                        timestamp INTEGER)''', {"timestamp"}, (
+        "CREATE INDEX idx_sensor_data_timestamp ON sensor_data(timestamp)",
+    ))
+    _convert_table(cursor, "sleep_sessions", '''CREATE TABLE {table} (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        start_time INTEGER,
+                        end_time INTEGER,
+                        duration_minutes INTEGER,
+                        avg_temperature REAL,
+                        avg_light REAL,
+                        quality TEXT,
+                        sample_count INTEGER DEFAULT 0,
+                        temp_sum REAL DEFAULT 0,
+                        light_sum REAL DEFAULT 0,
+                        min_temperature REAL,
+                        max_temperature REAL,
+                        min_light REAL,
+                        max_light REAL)''', {"start_time", "end_time"}, (
+        "CREATE INDEX idx_sleep_sessions_start_time ON sleep_sessions(start_time)",
+        "CREATE INDEX idx_sleep_sessions_active ON sleep_sessions(start_time) WHERE end_time IS NULL",
+        "CREATE UNIQUE INDEX idx_sleep_sessions_one_open ON sleep_sessions((end_time IS NULL)) WHERE end_time IS NULL",
+    ))
+    _convert_table(cursor, "rooms", '''CREATE TABLE {table} (
+                        name TEXT PRIMARY KEY,
+                        created_at INTEGER)''', {"created_at"})
+    for table, _ in rollups.ROLLUPS:
+        _convert_table(cursor, table, rollups.TABLE_DEFINITION, {"bucket"})
+
+    # Detector state saved by worker processes holds text times; have them rebuild it
+    cursor.execute("UPDATE worker_state SET detector = NULL, last_reading_id = NULL, detector_version = detector_version + 1")
+    summaries.rebuild(conn)
+    summaries.mark_changed(conn)
+    rollups.roll_up(conn)
+
+
+# Ordered schema upgrades; append new steps, never edit or reorder applied ones
+MIGRATIONS = (
+    (1, _create_base_tables),
+    (2, _add_session_aggregates),
+    (3, _add_indexes),
+    (4, _add_preferences_version),
+    (5, _create_rollup_tables),
+    (6, _create_rooms_table),
+    (7, _create_daily_summaries),
+    (8, _create_worker_state),
+    (9, _add_open_session_guard),
+    (10, _add_rollup_time_weights),
+    (11, _store_epoch_ms),
+)
+
+
+def schema_version(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """Brings the database up to the latest schema version, one transaction per step."""
+    if schema_version(conn) >= MIGRATIONS[-1][0]:
+        return
+    for version, upgrade in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-checked under the write lock in case another process got here first
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            upgrade(conn.cursor())
+            conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            conn.commit()
+            print(f"Applied database migration {version}: {upgrade.__module__}.{upgrade.__name__.strip('_')}")
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# "INSERT INTO sensor_data ..." -> "insert sensor_data"
+_STATEMENT_PATTERN = re.compile(r"^\s*(\w+)(?:.*?\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+))?", re.IGNORECASE | re.DOTALL)
+_statement_labels = {}
+
+
+def statement_label(sql):
+    """Short, low-cardinality name for a statement, cached per SQL string."""
+    label = _statement_labels.get(sql)
+    if label is None:
+        match = _STATEMENT_PATTERN.match(sql)
+        verb, table = (match.group(1).lower(), match.group(2)) if match else ("other", None)
+        if verb == "update" and not table:
+            table = sql.split()[1]
+        label = _statement_labels[sql] = f"{verb} {table}" if table else verb
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long each statement takes to execute."""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.SQL_LATENCY.observe(time.perf_counter() - started, statement_label(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.SQL_LATENCY.observe(time.perf_counter() - started, statement_label(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements, direct or through a cursor, are timed by TimedCursor."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(path=None):
+    """Opens a new connection with the tuned pragmas applied."""
+    factory = TimedConnection if metrics.ENABLED else sqlite3.Connection
+    conn = sqlite3.connect(path or DB_PATH, check_same_thread=False, factory=factory)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Keeps a bounded set of open connections that threads check out and return."""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path)
+
+    def release(self, conn):
+        # Never hand a half-finished transaction to the next thread
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    """Returns the pool for a database file, migrating the schema the first time it is opened."""
+    path = path or DB_PATH
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = ConnectionPool(path)
+            conn = pool.acquire()
+            try:
+                migrate(conn)
+            finally:
+                pool.release(conn)
+            _pools[path] = pool
+        return pool
+
+
+def close_pools():
+    """Closes every pooled connection that isn't checked out, e.g. at shutdown."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+
+
+def room_path(path, room):
+    """Database file holding one room's data; the default room lives in the main file itself.
+
+    Giving every room its own file means writers for different rooms never wait on
+    the same SQLite lock.
+    """
+    if room == DEFAULT_ROOM:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{room}{ext or '.db'}"
+
+
+def register_room(path, room):
+    """Records a room in the main database's registry, once."""
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO rooms (name, created_at) VALUES (?, ?)", (room, datetime.now()))
+    finally:
+        pool.release(conn)
+
+
+def list_rooms(path):
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try:
+        rows = conn.execute("SELECT name FROM rooms ORDER BY name").fetchall()
+    finally:
+        pool.release(conn)
+    return sorted({DEFAULT_ROOM} | {row[0] for row in rows})
@@ -0,0 +1,51 @@
+import timestamps
+
+
+class Deadband:
+    """Decides which readings are worth storing when most of them repeat the previous one.
+
+    A reading is kept when temperature or light moved further than its tolerance from
+    the last stored row, when the bed's occupancy changed, when a value appeared or went
+    missing, or when `heartbeat` seconds passed since the last stored row. Readers treat
+    each stored row as holding until the next one, so the heartbeat bounds how stale the
+    reconstructed series can be and tells a quiet sensor from a dead one.
+    """
+
+    def __init__(self, temperature=0.2, light=2, heartbeat=60):
+        self.tolerances = {"temp": temperature, "light": light}
+        self.heartbeat = heartbeat
+
+    def keep(self, last, reading):
+        """Whether `reading` (with its "time") differs enough from `last`, the stored row as returned by last_stored."""
+        if last is None:
+            return True
+        elapsed = (reading["time"] - last["time"]).total_seconds()
+        if elapsed < 0 or elapsed >= self.heartbeat:
+            return True
+        # Occupancy drives session detection, so every change of it is stored
+        if reading.get("pressure") != last["pressure"]:
+            return True
+        for key, tolerance in self.tolerances.items():
+            value, stored = reading.get(key), last[key]
+            if (value is None) != (stored is None):
+                return True
+            if value is not None and abs(value - stored) > tolerance:
+                return True
+        return False
+
+    def filter(self, last, readings):
+        """The readings to store, in order, each compared with the last one kept."""
+        kept = []
+        for reading in readings:
+            if self.keep(last, reading):
+                kept.append(reading)
+                last = reading
+        return kept
+
+
+def last_stored(conn):
+    """The newest stored reading in the shape Deadband.keep compares against, or None."""
+    row = conn.execute("SELECT timestamp, temperature, light, pressure FROM sensor_data ORDER BY id DESC LIMIT 1").fetchone()
+    if row is None:
+        return None
+    return {"time": timestamps.from_ms(row[0]), "temp": row[1], "light": row[2], "pressure": row[3]}
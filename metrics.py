@@ -0,0 +1,136 @@
+import bisect
+import os
+import threading
+
+# Instrumentation is cheap (a lock, a bisect and two clock reads per observation),
+# but can be switched off entirely with SMART_BEDROOM_METRICS=0
+ENABLED = os.environ.get("SMART_BEDROOM_METRICS", "1") != "0"
+
+# Seconds; spans a fast SQLite statement up to a slow history export
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label combination."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield self.name + _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """Bucketed distribution per label combination, rendered with cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket" + _format_labels(self.labels, labels, ("le", _format_number(bound))), cumulative
+            yield self.name + "_sum" + _format_labels(self.labels, labels), total
+            yield self.name + "_count" + _format_labels(self.labels, labels), cumulative
+
+
+class Gauge:
+    """Single value that goes up and down, read from a function at scrape time."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        REGISTRY.append(self)
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        yield self.name, self.function() if self.function else 0
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {_format_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_LATENCY = Histogram("smart_bedroom_http_request_duration_seconds",
+                            "Time to produce a response, by route (streams: until the first byte).",
+                            ("method", "route", "status"))
+SQL_LATENCY = Histogram("smart_bedroom_sql_statement_duration_seconds",
+                        "Time SQLite spent executing a statement, by statement kind and table.",
+                        ("statement",))
+SAMPLES_INGESTED = Counter("smart_bedroom_samples_ingested_total", "Sensor readings stored.", ("room",))
+SAMPLES_SKIPPED = Counter("smart_bedroom_samples_skipped_total", "Sensor readings left out by deadband compression.", ("room",))
+SESSIONS_STARTED = Counter("smart_bedroom_sleep_sessions_started_total", "Sleep sessions opened.", ("room",))
+SESSIONS_ENDED = Counter("smart_bedroom_sleep_sessions_ended_total", "Sleep sessions closed.", ("room",))
+WRITE_BEHIND_DEPTH = Gauge("smart_bedroom_write_behind_queue_depth", "Readings accepted but not yet committed.")
+WRITE_BEHIND_GROUP_SIZE = Histogram("smart_bedroom_write_behind_group_size", "Readings committed together by the write-behind writer.",
+                                    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+LONG_REQUESTS_OPEN = Gauge("smart_bedroom_long_requests_open", "Live streams and preference long-polls currently held open.")
+LONG_REQUESTS_REJECTED = Counter("smart_bedroom_long_requests_rejected_total", "Streams and long-polls turned away with a 503 at the limit.")
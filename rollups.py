@@ -0,0 +1,244 @@
+import time
+from datetime import datetime, timedelta
+
+import timestamps
+
+# Rollup table and its bucket size in milliseconds; a bucket is keyed by its start in epoch ms
+ROLLUPS = (
+    ("sensor_rollup_minute", 60000),
+    ("sensor_rollup_hour", 3600000),
+)
+
+METRICS = ("temperature", "light", "pressure")
+
+# Each stored value is taken to hold until the next row, but a longer gap than this
+# means the device was offline and the gap counts for nothing
+MAX_HOLD = 600  # seconds
+
+# Rows deleted per write transaction when pruning, and the pause between transactions
+PRUNE_CHUNK_SIZE = 5000
+PRUNE_CHUNK_PAUSE = 0.05  # seconds
+
+
+# Seconds each metric held a value, and value x seconds, for time-weighted averages
+WEIGHT_COLUMNS = tuple((f"{metric}_seconds", "REAL DEFAULT 0") for metric in METRICS) + \
+                 tuple((f"{metric}_weighted", "REAL DEFAULT 0") for metric in METRICS)
+
+
+_COLUMNS = ",\n".join(
+    [f"{metric}_sum REAL DEFAULT 0, {metric}_min REAL, {metric}_max REAL" for metric in METRICS]
+    + [f"{column} {definition}" for column, definition in WEIGHT_COLUMNS]
+)
+# With a {table} placeholder; database migration 11 builds the current tables from it
+TABLE_DEFINITION = f'''CREATE TABLE IF NOT EXISTS {{table}} (
+                        bucket INTEGER PRIMARY KEY,
+                        sample_count INTEGER DEFAULT 0,
+                        {_COLUMNS})'''
+
+
+def roll_up(conn):
+    """Folds every sensor_data row past the watermark into the minute and hour rollups.
+
+    Meant to run inside the ingestion transaction, so it usually only sees the rows
+    that transaction just inserted. Besides plain sums, each row's value is weighted by
+    the time it held until the next row, and the newest row's share is added once the
+    row after it arrives. That keeps averages right when unchanged readings were never
+    stored.
+    """
+    last_id = conn.execute("SELECT last_id FROM rollup_watermark").fetchone()[0]
+    new_last_id = conn.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0]
+    if new_last_id is None or new_last_id <= last_id:
+        return 0
+
+    aggregates = ", ".join(
+        f"TOTAL(CASE WHEN is_new THEN {metric} END), MIN(CASE WHEN is_new THEN {metric} END), MAX(CASE WHEN is_new THEN {metric} END)"
+        for metric in METRICS
+    )
+    weighted = ", ".join(
+        [f"TOTAL(CASE WHEN {metric} IS NOT NULL THEN weight END)" for metric in METRICS]
+        + [f"TOTAL({metric} * weight)" for metric in METRICS]
+    )
+    columns = ", ".join(
+        [f"{metric}_sum, {metric}_min, {metric}_max" for metric in METRICS]
+        + [column for column, _ in WEIGHT_COLUMNS]
+    )
+    merges = ",\n".join(
+        [f"{metric}_sum = {metric}_sum + excluded.{metric}_sum, "
+         f"{metric}_min = MIN(COALESCE({metric}_min, excluded.{metric}_min), COALESCE(excluded.{metric}_min, {metric}_min)), "
+         f"{metric}_max = MAX(COALESCE({metric}_max, excluded.{metric}_max), COALESCE(excluded.{metric}_max, {metric}_max))"
+         for metric in METRICS]
+        + [f"{column} = {column} + excluded.{column}" for column, _ in WEIGHT_COLUMNS]
+    )
+
+    # Holds run in time order from the newest row already rolled up, whose hold is still open.
+    # A new row older than it arrived late: the time it covers was already credited to the
+    # row before it, so it only adds to the plain sums.
+    newest = conn.execute("""
+        SELECT timestamp, id FROM sensor_data WHERE id <= ? ORDER BY timestamp DESC, id DESC LIMIT 1
+    """, (last_id,)).fetchone() or (-1, 0)
+
+    values = ", ".join(METRICS)
+    for table, bucket_size in ROLLUPS:
+        # A hold is split at bucket boundaries and each bucket it covers, including ones with no
+        # row of their own, is credited with its share. No hold is longer than MAX_HOLD, which
+        # bounds how many buckets one can cover.
+        conn.execute(f"""
+            WITH steps AS (
+                SELECT id, timestamp, {values}, LEAD(timestamp) OVER (ORDER BY timestamp, id) AS next_time
+                FROM sensor_data
+                WHERE id = :newest_id
+                   OR (id > :last_id AND id <= :new_last_id AND (timestamp, id) > (:newest_time, :newest_id))
+                UNION ALL
+                SELECT id, timestamp, {values}, NULL
+                FROM sensor_data
+                WHERE id > :last_id AND id <= :new_last_id AND (timestamp, id) < (:newest_time, :newest_id)
+            ), spans AS (
+                SELECT *, timestamp - timestamp % :size AS first_bucket,
+                       next_time - timestamp <= :max_hold * 1000 AND next_time > timestamp AS holds
+                FROM steps
+            ), offsets(n) AS (
+                SELECT 0 UNION ALL SELECT n + 1 FROM offsets WHERE n < :max_hold * 1000 / :size + 1
+            ), parts AS (
+                SELECT first_bucket + n * :size AS bucket, id > :last_id AND n = 0 AS is_new, {values},
+                       CASE WHEN holds THEN
+                           (MIN(next_time, first_bucket + (n + 1) * :size) - MAX(timestamp, first_bucket + n * :size)) / 1000.0
+                       END AS weight
+                FROM spans JOIN offsets ON n = 0 OR (holds AND first_bucket + n * :size < next_time)
+            )
+            INSERT INTO {table} (bucket, sample_count, {columns})
+            SELECT bucket, SUM(is_new), {aggregates}, {weighted}
+            FROM parts
+            GROUP BY bucket
+            ON CONFLICT(bucket) DO UPDATE SET
+                sample_count = sample_count + excluded.sample_count,
+                {merges}
+        """, {"last_id": last_id, "new_last_id": new_last_id, "newest_time": newest[0], "newest_id": newest[1],
+              "size": bucket_size, "max_hold": MAX_HOLD})
+
+    conn.execute("UPDATE rollup_watermark SET last_id = ?", (new_last_id,))
+    return new_last_id - last_id
+
+
+def prune_raw_data(conn, retention_days, chunk_size=PRUNE_CHUNK_SIZE):
+    """Deletes raw readings older than `retention_days` that are already in the rollups, then reclaims the pages.
+
+    Rows go in chunks of `chunk_size`, each in its own write transaction, so ingestion
+    is never blocked for longer than one chunk. Databases created before incremental
+    vacuum was enabled keep their free pages for new rows instead;
+    scripts/enable_incremental_vacuum.py converts them offline.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        roll_up(conn)
+    cutoff = timestamps.to_ms(datetime.now() - timedelta(days=retention_days))
+    deleted = _delete_in_chunks(conn, """
+        DELETE FROM sensor_data WHERE id IN (
+            SELECT id FROM sensor_data
+            WHERE timestamp < ? AND id <= (SELECT last_id FROM rollup_watermark)
+            ORDER BY id
+            LIMIT ?
+        )
+    """, cutoff, chunk_size)
+    _reclaim_pages(conn, deleted)
+    return deleted
+
+
+def prune_minute_rollups(conn, retention_days, chunk_size=PRUNE_CHUNK_SIZE):
+    """Deletes minute buckets older than `retention_days`; the hourly rollup keeps their totals."""
+    cutoff = minute_rollup_start(retention_days)
+    deleted = _delete_in_chunks(conn, """
+        DELETE FROM sensor_rollup_minute WHERE bucket IN (
+            SELECT bucket FROM sensor_rollup_minute
+            WHERE bucket < ?
+            ORDER BY bucket
+            LIMIT ?
+        )
+    """, cutoff, chunk_size)
+    _reclaim_pages(conn, deleted)
+    return deleted
+
+
+def minute_rollup_start(retention_days):
+    """Epoch ms of the oldest minute bucket kept, aligned to an hour so it never splits one."""
+    cutoff = timestamps.to_ms(datetime.now() - timedelta(days=retention_days))
+    return cutoff - cutoff % 3600000
+
+
+def _delete_in_chunks(conn, sql, cutoff, chunk_size):
+    deleted = 0
+    while True:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            count = conn.execute(sql, (cutoff, chunk_size)).rowcount
+        deleted += count
+        if count < chunk_size:
+            return deleted
+        # Let waiting writers take the lock before the next chunk
+        time.sleep(PRUNE_CHUNK_PAUSE)
+
+
+def _reclaim_pages(conn, deleted):
+    if deleted and conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        conn.execute("PRAGMA incremental_vacuum")
+
+
+# History bucket sizes in seconds; 0 means raw readings
+BUCKETS = {"raw": 0, "1m": 60, "5m": 300, "15m": 900, "1h": 3600, "6h": 21600, "1d": 86400}
+
+
+def pick_bucket(start, end, max_points=2000):
+    """Smallest bucket that keeps a range under `max_points` points, raw for anything up to an hour."""
+    seconds = (end - start).total_seconds()
+    if seconds <= 3600:
+        return "raw"
+    for name, size in BUCKETS.items():
+        if size and seconds / size <= max_points:
+            return name
+    return "1d"
+
+
+def iter_raw(conn, start, end, after=None, limit=1000):
+    """Raw readings in [start, end) (epoch ms) ordered by (timestamp, id), resuming after a (timestamp, id) cursor."""
+    after_timestamp, after_id = after or (start, 0)
+    # SQLite won't seek the index on the row-value comparison alone, so the cursor also raises the lower bound
+    return conn.execute("""
+        SELECT id, timestamp, temperature, light, pressure
+        FROM sensor_data
+        WHERE timestamp >= ? AND timestamp < ? AND (timestamp, id) > (?, ?)
+        ORDER BY timestamp, id
+        LIMIT ?
+    """, (max(start, after_timestamp), end, after_timestamp, after_id, limit))
+
+
+def value_at(conn, time):
+    """The last reading stored before `time` (epoch ms), as iter_raw returns it, if it still held then (see MAX_HOLD)."""
+    return conn.execute("""
+        SELECT id, timestamp, temperature, light, pressure
+        FROM sensor_data
+        WHERE timestamp < ? AND timestamp >= ?
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1
+    """, (time, time - MAX_HOLD * 1000)).fetchone()
+
+
+def iter_buckets(conn, size, start, end, limit=1000, utc_offset=0, minute_since=None):
+    """Aggregated points of `size` seconds in [start, end) (epoch ms), read from the coarsest rollup that fits.
+
+    Points start at multiples of `size` in local time, `utc_offset` milliseconds ahead of UTC,
+    so e.g. daily points begin at local midnight. Ranges starting before `minute_since`,
+    where minute buckets have been pruned, are read from the hourly rollup instead.
+    """
+    minutes = size < 3600 and (minute_since is None or start >= minute_since)
+    table = "sensor_rollup_minute" if minutes else "sensor_rollup_hour"
+    aggregates = ", ".join(
+        [f"TOTAL({metric}_sum), MIN({metric}_min), MAX({metric}_max)" for metric in METRICS]
+        + [f"TOTAL({metric}_seconds), TOTAL({metric}_weighted)" for metric in METRICS]
+    )
+    return conn.execute(f"""
+        SELECT (bucket + :offset) / :size * :size - :offset AS point, SUM(sample_count), {aggregates}
+        FROM {table}
+        WHERE bucket >= :start AND bucket < :end
+        GROUP BY point
+        ORDER BY point
+        LIMIT :limit
+    """, {"offset": utc_offset, "size": size * 1000, "start": start, "end": end, "limit": limit})
@@ -0,0 +1,158 @@
+import json
+
+import numpy as np
+
+import summaries
+
+# Each factor scores 3 inside its ideal range, 2 inside its acceptable range and 1 otherwise.
+# The total maps to the first grade whose minimum it reaches.
+DEFAULT_THRESHOLDS = {
+    "temperature": {"ideal": [18, 22], "acceptable": [16, 24]},   # °C
+    "light": {"ideal": [0, 15], "acceptable": [0, 30]},           # %
+    "duration_hours": {"ideal": [7, 9], "acceptable": [6, 10]},
+    "grades": [[8, "Excellent"], [6, "Good"], [4, "Fair"]],
+    "lowest_grade": "Poor",
+}
+
+UNKNOWN = "Unknown"
+
+
+def load_thresholds(path=None):
+    """Default thresholds, with any keys from the JSON file at `path` replacing them; raises ValueError if invalid."""
+    if not path:
+        return merge_thresholds(DEFAULT_THRESHOLDS, {})
+    with open(path) as f:
+        return merge_thresholds(DEFAULT_THRESHOLDS, json.load(f))
+
+
+def merge_thresholds(base, overrides):
+    """A copy of `base` with `overrides` applied, down to single ranges; raises ValueError if the result is invalid.
+
+    Checked here so a bad override is refused up front rather than when a session closes.
+    """
+    thresholds = json.loads(json.dumps(base))
+    if not isinstance(overrides, dict):
+        raise ValueError("thresholds must be a JSON object")
+    for key, value in overrides.items():
+        if key not in DEFAULT_THRESHOLDS:
+            raise ValueError(f"unknown threshold {key!r}")
+        if isinstance(DEFAULT_THRESHOLDS[key], dict):
+            if not isinstance(value, dict) or not set(value) <= set(DEFAULT_THRESHOLDS[key]):
+                raise ValueError(f"{key!r} takes {', '.join(DEFAULT_THRESHOLDS[key])}")
+            thresholds[key].update(value)
+        else:
+            thresholds[key] = value
+    _validate_thresholds(thresholds)
+    return thresholds
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _validate_thresholds(thresholds):
+    for factor in ("temperature", "light", "duration_hours"):
+        for name in ("ideal", "acceptable"):
+            bounds = thresholds[factor][name]
+            if not (isinstance(bounds, list) and len(bounds) == 2 and all(map(_is_number, bounds))
+                    and bounds[0] <= bounds[1]):
+                raise ValueError(f"{factor}.{name} must be [low, high] numbers")
+    grades = thresholds["grades"]
+    if not isinstance(grades, list) or not all(
+            isinstance(grade, list) and len(grade) == 2 and _is_number(grade[0]) and isinstance(grade[1], str)
+            for grade in grades):
+        raise ValueError("grades must be [minimum score, grade] pairs")
+    if not isinstance(thresholds["lowest_grade"], str):
+        raise ValueError("lowest_grade must be a string")
+
+
+def _factor_score(value, ranges):
+    ideal_low, ideal_high = ranges["ideal"]
+    acceptable_low, acceptable_high = ranges["acceptable"]
+    return 1 + (acceptable_low <= value <= acceptable_high) + (ideal_low <= value <= ideal_high)
+
+
+def determine_sleep_quality(avg_temp, avg_light, duration, thresholds=DEFAULT_THRESHOLDS):
+    """Quality of one session; `duration` is in minutes."""
+    quality_score = (
+        _factor_score(avg_temp, thresholds["temperature"])
+        + _factor_score(avg_light, thresholds["light"])
+        + _factor_score(duration / 60, thresholds["duration_hours"])
+    )
+
+    for minimum, grade in thresholds["grades"]:
+        if quality_score >= minimum:
+            return grade
+    return thresholds["lowest_grade"]
+
+
+def _factor_scores(values, ranges):
+    ideal_low, ideal_high = ranges["ideal"]
+    acceptable_low, acceptable_high = ranges["acceptable"]
+    return (1
+            + ((values >= acceptable_low) & (values <= acceptable_high))
+            + ((values >= ideal_low) & (values <= ideal_high)))
+
+
+def score_sessions(avg_temps, avg_lights, durations, thresholds=DEFAULT_THRESHOLDS):
+    """Vectorized determine_sleep_quality over whole arrays of sessions.
+
+    Missing temperatures or light levels (None/NaN) score as "Unknown", like an
+    open session closed without samples.
+    """
+    avg_temps = np.asarray(avg_temps, dtype=float)
+    avg_lights = np.asarray(avg_lights, dtype=float)
+    durations = np.asarray(durations, dtype=float)
+
+    scores = (
+        _factor_scores(avg_temps, thresholds["temperature"])
+        + _factor_scores(avg_lights, thresholds["light"])
+        + _factor_scores(np.nan_to_num(durations) / 60, thresholds["duration_hours"])
+    )
+
+    grades = thresholds["grades"]
+    qualities = np.select([scores >= minimum for minimum, _ in grades],
+                          [grade for _, grade in grades],
+                          default=thresholds["lowest_grade"]).astype(object)
+    qualities[np.isnan(avg_temps) | np.isnan(avg_lights)] = UNKNOWN
+    return qualities
+
+
+def rescore_sessions(conn, thresholds=DEFAULT_THRESHOLDS, chunk_size=50000):
+    """Recomputes `quality` for every finished session, one chunk and one transaction at a time.
+
+    Only rows whose quality actually changes are written, and the daily summaries
+    that embed them are rebuilt afterwards. Returns (scored, changed).
+    """
+    scored = changed = 0
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, avg_temperature, avg_light, duration_minutes, quality
+            FROM sleep_sessions
+            WHERE end_time IS NOT NULL AND id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+
+        # NULL columns become NaN when converted to float arrays
+        ids, avg_temps, avg_lights, durations, current = zip(*rows)
+        qualities = score_sessions(avg_temps, avg_lights, durations, thresholds)
+
+        updates = [(str(quality), session_id)
+                   for session_id, quality, old in zip(ids, qualities, current)
+                   if quality != old]
+        with conn:
+            conn.executemany("UPDATE sleep_sessions SET quality = ? WHERE id = ?", updates)
+
+        scored += len(rows)
+        changed += len(updates)
+        last_id = ids[-1]
+
+    if changed:
+        with conn:
+            summaries.rebuild(conn)
+            summaries.mark_changed(conn)
+    return scored, changed
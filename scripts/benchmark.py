@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+DASHBOARD_ENDPOINTS = ("/api/current-data", "/api/sleep-history", "/api/sleep-stats")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(db_path, port):
+    """Runs server.py in its own process against the scratch database."""
+    env = dict(os.environ, SMART_BEDROOM_DB=db_path)
+    code = f"import server; server.init_db(); server.app.run(port={port}, threaded=True)"
+    server = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(base_url + "/api/preferences", timeout=1)
+            return server, base_url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+class Recorder:
+    """Collects per-endpoint latencies and errors from every worker thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def paced(rate, stop):
+    """Yields at `rate` times per second until stopped, without drifting when a request runs long."""
+    interval = 1 / rate
+    next_time = time.perf_counter() + random.uniform(0, interval)
+    while not stop.is_set():
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            stop.wait(delay)
+        next_time += interval
+        yield
+
+def timed_request(http, recorder, endpoint, method, url, **kwargs):
+    started = time.perf_counter()
+    try:
+        ok = http.request(method, url, timeout=10, **kwargs).status_code < 400
+    except requests.exceptions.RequestException:
+        ok = False
+    recorder.record(endpoint, time.perf_counter() - started, ok)
+
+def room_name(number):
+    # Same names populate_sleep.py gives its rooms
+    return "default" if number == 0 else f"room{number + 1}"
+
+def device(base_url, rate, recorder, stop, room):
+    http = requests.Session()
+    pressure = random.randint(0, 1)
+    for _ in paced(rate, stop):
+        # Flip in and out of bed now and then so sessions open and close during the run
+        if random.random() < 0.01:
+            pressure = 1 - pressure
+        reading = {"temp": round(random.uniform(16, 25), 1), "light": round(random.uniform(0, 80), 1), "pressure": pressure, "room": room}
+        timed_request(http, recorder, "/api/sensor-data", "POST", base_url + "/api/sensor-data", json=reading)
+
+def dashboard(base_url, rate, recorder, stop, room):
+    http = requests.Session()
+    for _ in paced(rate, stop):
+        for endpoint in DASHBOARD_ENDPOINTS:
+            timed_request(http, recorder, endpoint, "GET", base_url + endpoint, params={"room": room})
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(recorder, duration):
+    results = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        results[endpoint] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(endpoint, 0),
+            "throughput_rps": round(len(latencies) / duration, 2),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+    return results
+
+def print_results(results, baseline=None):
+    print(f"{'endpoint':<22}{'req':>8}{'err':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint, stats in results.items():
+        line = (f"{endpoint:<22}{stats['requests']:>8}{stats['errors']:>6}{stats['throughput_rps']:>9}"
+                f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+        previous = (baseline or {}).get(endpoint)
+        if previous:
+            change = (stats["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] * 100 if previous["p95_ms"] else 0
+            line += f"   p95 {change:+.0f}% vs baseline"
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-tests the Flask API against a scratch database and reports latency per endpoint.")
+    parser.add_argument("--devices", type=int, default=4, help="simulated devices posting sensor data")
+    parser.add_argument("--device-rate", type=float, default=0.5, help="posts per second per device")
+    parser.add_argument("--dashboards", type=int, default=4, help="simulated dashboard clients")
+    parser.add_argument("--dashboard-rate", type=float, default=0.2, help="polls per second per dashboard")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run the load")
+    parser.add_argument("--rooms", type=int, default=1, help="bedrooms to spread the devices and dashboards over")
+    parser.add_argument("--days", type=int, default=14, help="days of history to generate before the run (0 for an empty database)")
+    parser.add_argument("--interval", type=float, default=60, help="sample interval of the generated history, in seconds")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--output", default="benchmark_results.json", help="file to write machine-readable results to")
+    parser.add_argument("--baseline", help="earlier results file to compare p95 latency against")
+    args = parser.parse_args()
+
+    server = None
+    scratch = tempfile.TemporaryDirectory()
+    base_url = args.url
+    if not base_url:
+        db_path = os.path.join(scratch.name, "benchmark.db")
+        if args.days:
+            subprocess.run([sys.executable, os.path.join(ROOT, "scripts", "populate_sleep.py"), "--db", db_path,
+                            "--days", str(args.days), "--interval", str(args.interval), "--rooms", str(args.rooms), "--seed", "1"], check=True)
+        server, base_url = start_server(db_path, free_port())
+
+    recorder = Recorder()
+    stop = threading.Event()
+    workers = ([threading.Thread(target=device, args=(base_url, args.device_rate, recorder, stop, room_name(i % args.rooms)))
+                for i in range(args.devices)]
+               + [threading.Thread(target=dashboard, args=(base_url, args.dashboard_rate, recorder, stop, room_name(i % args.rooms)))
+                  for i in range(args.dashboards)])
+
+    try:
+        print(f"Running {args.devices} devices and {args.dashboards} dashboards in {args.rooms} room(s) against {base_url} for {args.duration}s...")
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        time.sleep(args.duration)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        scratch.cleanup()
+
+    results = summarize(recorder, elapsed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["endpoints"]
+    print_results(results, baseline)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "run_at": datetime.now().isoformat(timespec="seconds"),
+            "config": vars(args),
+            "duration_s": round(elapsed, 2),
+            "endpoints": results,
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
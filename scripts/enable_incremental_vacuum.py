@@ -0,0 +1,29 @@
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import database
+
+DEFAULT_DB_PATH = os.environ.get("SMART_BEDROOM_DB", os.path.join(ROOT, "smart_bedroom.db"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Switches databases created before incremental vacuum to it, so retention can give space back. "
+                    "Rewrites each file with a full VACUUM; stop the server first.")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="main database file; every room's file is converted (default: %(default)s)")
+    args = parser.parse_args()
+
+    for room in database.list_rooms(args.db):
+        path = database.room_path(args.db, room)
+        conn = database.connect(path)
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            print(f"{path}: already incremental")
+        else:
+            started = time.perf_counter()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            print(f"{path}: converted in {time.perf_counter() - started:.2f}s")
+        conn.close()
@@ -0,0 +1,37 @@
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import archive
+import database
+import timestamps
+
+DEFAULT_DB_PATH = os.environ.get("SMART_BEDROOM_DB", os.path.join(ROOT, "smart_bedroom.db"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports sensor readings to one .npy file per column for offline analysis.")
+    parser.add_argument("output", help="directory to write the column files to")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="main database file (default: %(default)s)")
+    parser.add_argument("--room", default=database.DEFAULT_ROOM, help="room to export (default: %(default)s)")
+    parser.add_argument("--from", dest="start", type=timestamps.parse, default=datetime.fromtimestamp(0),
+                        help="first reading time to include, e.g. 2025-01-01 (default: the oldest)")
+    parser.add_argument("--to", dest="end", type=timestamps.parse, default=None,
+                        help="export readings before this time (default: now)")
+    parser.add_argument("--chunk-size", type=int, default=archive.CHUNK_SIZE, help="rows read from SQLite at a time")
+    args = parser.parse_args()
+
+    conn = database.connect(database.room_path(args.db, args.room))
+    database.migrate(conn)
+
+    started = time.perf_counter()
+    count = archive.write_archive(conn, args.output, timestamps.to_ms(args.start),
+                                  timestamps.to_ms(args.end or datetime.now()), args.room, args.chunk_size)
+    elapsed = time.perf_counter() - started
+    conn.close()
+
+    print(f"Exported {count} readings to {args.output} in {elapsed:.2f}s")
+    print(f"Load them with: archive.load_archive({args.output!r})")
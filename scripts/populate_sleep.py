@@ -1,169 +1,187 @@
-import sqlite3
-import random
+import argparse
+import os
+import sys
+import time
 from datetime import datetime, timedelta
 
-# Add this function to handle datetime adaptation for SQLite
-def adapt_datetime(dt):
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
+import numpy as np
 
-def populate_sleep_sessions():
-    # Register the datetime adapter
-    sqlite3.register_adapter(datetime, adapt_datetime)
-    
-    conn = sqlite3.connect("../smart_bedroom.db")
-    cursor = conn.cursor()
-    
-    # Current date and time
-    now = datetime.now()
-    
-    # Generate 14 days of sleep data (2 weeks of history)
-    for day in range(14, 0, -1):
-        # Calculate the date for this sleep session
-        sleep_date = now - timedelta(days=day)
-        
-        # Random sleep start time between 9 PM and 12 AM
-        sleep_hour = random.randint(21, 23)
-        sleep_minute = random.randint(0, 59)
-        sleep_start = sleep_date.replace(hour=sleep_hour, minute=sleep_minute, second=0, microsecond=0)
-        
-        # Random sleep duration between 4 and 9 hours
-        sleep_duration = random.uniform(4, 9)
-        sleep_end = sleep_start + timedelta(hours=sleep_duration)
-        
-        # Random temperature between 16 and 24°C
-        avg_temp = random.uniform(14, 26)
-        
-        # Random light level between 0 and 40%
-        avg_light = random.uniform(0, 60)
-        
-        quality = determine_sleep_quality(avg_temp, avg_light, sleep_duration * 60)
-        
-        # Insert the sleep session
-        cursor.execute("""
-            INSERT INTO sleep_sessions 
-            (start_time, end_time, duration_minutes, avg_temperature, avg_light, quality)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            sleep_start.strftime("%Y-%m-%d %H:%M:%S"),
-            sleep_end.strftime("%Y-%m-%d %H:%M:%S"),
-            round(sleep_duration * 60),  # Convert hours to minutes
-            round(avg_temp, 1),
-            round(avg_light, 1),
-            quality
-        ))
-    
-    # Commit the changes
-    conn.commit()
-    
-    # Populate some sensor data for the last 24 hours
-    populate_sensor_data(conn, now)
-    
-    # Close the connection
-    conn.close()
-    
-    print(f"Successfully populated {14} sleep sessions!")
-
-def determine_sleep_quality(avg_temp, avg_light, duration):
-    quality_score = 0
-    
-    # Temperature factor (18-22°C is ideal)
-    if 18 <= avg_temp <= 22:
-        quality_score += 3
-    elif 16 <= avg_temp < 18 or 22 < avg_temp <= 24:
-        quality_score += 2
-    else:
-        quality_score += 1
-    
-    # Light factor (0-15% is ideal)
-    if 0 <= avg_light <= 15:
-        quality_score += 3
-    elif 15 < avg_light <= 30:
-        quality_score += 2
-    else:
-        quality_score += 1
-    
-    # Duration factor (7-9 hours is ideal)
-    duration_hours = duration / 60
-    if 7 <= duration_hours <= 9:
-        quality_score += 3
-    elif 6 <= duration_hours < 7 or 9 < duration_hours <= 10:
-        quality_score += 2
-    else:
-        quality_score += 1
-    
-    # Convert score to quality
-    if quality_score >= 8:
-        return "Excellent"
-    elif quality_score >= 6:
-        return "Good"
-    elif quality_score >= 4:
-        return "Fair"
-    else:
-        return "Poor"
-
-def populate_sensor_data(conn, now):
-    cursor = conn.cursor()
-    
-    # Generate data points for the last 24 hours
-    for hour in range(24, 0, -1):
-        timestamp = now - timedelta(hours=hour)
-        
-        # Normal values during day (6 AM - 10 PM)
-        if 6 <= timestamp.hour < 22:
-            temp = random.uniform(20, 25)  # Room temperature
-            light = random.uniform(30, 90)  # Daylight
-            pressure = random.randint(0, 1)  # Normally not in bed
-        else:
-            # Nighttime values
-            temp = random.uniform(16, 22)  # Cooler at night
-            light = random.uniform(0, 15)  # Dark at night
-            pressure = random.randint(1, 5)  # In bed
-        
-        # Insert the sensor data
-        cursor.execute("""
-            INSERT INTO sensor_data 
-            (temperature, light, pressure, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (
-            round(temp, 1),
-            round(light, 1),
-            pressure,
-            timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        ))
-    
-    # Add a few recent data points
-    for minute in range(60, 0, -5):
-        timestamp = now - timedelta(minutes=minute)
-        temp = random.uniform(20, 23)
-        light = random.uniform(40, 70)
-        pressure = 0
-        
-        cursor.execute("""
-            INSERT INTO sensor_data 
-            (temperature, light, pressure, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (
-            round(temp, 1),
-            round(light, 1),
-            pressure,
-            timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        ))
-    
-    conn.commit()
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import database
+import rollups
+import scoring
+import summaries
+
+DEFAULT_DB_PATH = os.environ.get("SMART_BEDROOM_DB", os.path.join(ROOT, "smart_bedroom.db"))
+EPOCH = datetime(1970, 1, 1)
+
+# Trade durability for speed while bulk loading; the server switches back to WAL on its next connection
+BULK_PRAGMAS = (
+    "PRAGMA journal_mode=MEMORY",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA locking_mode=EXCLUSIVE",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Generated times are local wall-clock seconds counted as if they were UTC, so days
+# and hours fall on multiples of 86400 and 3600; this stores them as real epoch ms
+LOCAL_SECONDS_TO_MS = "CAST(strftime('%s', ?, 'unixepoch', 'utc') AS INTEGER) * 1000"
+
+def naive_epoch(dt):
+    return (dt - EPOCH).total_seconds()
+
+def generate_sessions(rng, start, end):
+    """One night per day: into bed between 9 PM and midnight for 4 to 9 hours, ending before `end`."""
+    first_day = naive_epoch(datetime(start.year, start.month, start.day))
+    days = np.arange(first_day, naive_epoch(end), 86400)
+    starts = days + rng.uniform(21 * 3600, 24 * 3600, len(days))
+    ends = starts + rng.uniform(4 * 3600, 9 * 3600, len(days))
+    keep = (starts >= naive_epoch(start)) & (ends <= naive_epoch(end))
+    starts, ends = np.floor(starts[keep]), np.floor(ends[keep])
+
+    # How warm and bright each night's room is relative to an ideal bedroom
+    temp_offsets = rng.uniform(-5, 5, len(starts))
+    light_offsets = rng.uniform(0, 40, len(starts))
+    return starts, ends, temp_offsets, light_offsets
+
+def generate_readings(rng, times, sessions):
+    """Temperature, light and pressure for each sample time, plus the session each in-bed sample belongs to."""
+    starts, ends, temp_offsets, light_offsets = sessions
+    session = np.searchsorted(starts, times, side="right") - 1
+    in_bed = (session >= 0) & (times < ends[np.maximum(session, 0)])
+
+    hour = (times % 86400) / 3600
+    daylight = np.clip(np.sin((hour - 6) / 16 * np.pi), 0, None)
+
+    temps = 20 + 3 * daylight + rng.normal(0, 0.3, len(times))
+    lights = 90 * daylight + rng.uniform(0, 10, len(times))
+    night = session[in_bed]
+    temps[in_bed] = 19 + temp_offsets[night] + rng.normal(0, 0.5, len(night))
+    lights[in_bed] = light_offsets[night] + rng.uniform(0, 5, len(night))
+
+    return np.round(temps, 1), np.round(np.clip(lights, 0, 100), 1), in_bed.astype(int), np.where(in_bed, session, -1)
+
+def room_names(rooms):
+    """The first simulated room is the default one, the rest are room2, room3, ..."""
+    return [database.DEFAULT_ROOM] + [f"room{number}" for number in range(2, rooms + 1)]
 
-def drop_database():
-    # Register the datetime adapter
-    sqlite3.register_adapter(datetime, adapt_datetime)
-    
-    conn = sqlite3.connect("../smart_bedroom.db")
+def populate(conn, rng, start, end, interval, offset=0, chunk_seconds=86400):
+    """Bulk-loads sensor rows and matching sleep sessions for one room, one transaction per day of data."""
+    sensor_rows = 0
+    sessions = generate_sessions(rng, start, end)
+    count = np.zeros(len(sessions[0]))
+    temp_sum, light_sum = np.zeros(len(count)), np.zeros(len(count))
+    temp_min, light_min = np.full(len(count), np.inf), np.full(len(count), np.inf)
+    temp_max, light_max = np.full(len(count), -np.inf), np.full(len(count), -np.inf)
+
+    # Stagger rooms so their samples interleave rather than share timestamps
+    first = naive_epoch(start) + offset
+    for chunk_start in np.arange(first, naive_epoch(end), chunk_seconds):
+        times = np.floor(np.arange(chunk_start, min(chunk_start + chunk_seconds, naive_epoch(end)), interval))
+        temps, lights, pressure, session = generate_readings(rng, times, sessions)
+
+        with conn:
+            conn.executemany(
+                f"INSERT INTO sensor_data (temperature, light, pressure, timestamp) VALUES (?, ?, ?, {LOCAL_SECONDS_TO_MS})",
+                zip(temps.tolist(), lights.tolist(), pressure.tolist(), times.tolist()))
+        sensor_rows += len(times)
+
+        # Same running aggregates the server keeps while a session is open
+        in_bed = session >= 0
+        night = session[in_bed]
+        np.add.at(count, night, 1)
+        np.add.at(temp_sum, night, temps[in_bed])
+        np.add.at(light_sum, night, lights[in_bed])
+        np.minimum.at(temp_min, night, temps[in_bed])
+        np.maximum.at(temp_max, night, temps[in_bed])
+        np.minimum.at(light_min, night, lights[in_bed])
+        np.maximum.at(light_max, night, lights[in_bed])
+
+    starts, ends = sessions[0], sessions[1]
+    sampled = count > 0
+    avg_temps = np.where(sampled, temp_sum / np.maximum(count, 1), np.nan)
+    avg_lights = np.where(sampled, light_sum / np.maximum(count, 1), np.nan)
+    durations = (ends - starts) / 60
+    qualities = scoring.score_sessions(avg_temps, avg_lights, durations)
+
+    def nullable(values):
+        return [None if not np.isfinite(value) else round(float(value), 1) for value in values]
+
+    with conn:
+        conn.executemany(f"""
+            INSERT INTO sleep_sessions
+            (start_time, end_time, duration_minutes, avg_temperature, avg_light, quality,
+             sample_count, temp_sum, light_sum, min_temperature, max_temperature, min_light, max_light)
+            VALUES ({LOCAL_SECONDS_TO_MS}, {LOCAL_SECONDS_TO_MS}, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, zip(starts.tolist(), ends.tolist(), np.round(durations).astype(int).tolist(),
+                 nullable(avg_temps), nullable(avg_lights), [str(q) for q in qualities],
+                 count.astype(int).tolist(), temp_sum.tolist(), light_sum.tolist(),
+                 nullable(temp_min), nullable(temp_max), nullable(light_min), nullable(light_max)))
+    return sensor_rows, len(starts)
+
+def drop_database(path):
+    conn = database.connect(path)
     cursor = conn.cursor()
     cursor.execute("DROP TABLE IF EXISTS sleep_sessions")
     cursor.execute("DROP TABLE IF EXISTS sensor_data")
-    cursor.execute("CREATE TABLE sleep_sessions (id INTEGER PRIMARY KEY, start_time TEXT, end_time TEXT, duration_minutes INTEGER, avg_temperature REAL, avg_light REAL, quality TEXT)")
-    cursor.execute("CREATE TABLE sensor_data (id INTEGER PRIMARY KEY, temperature REAL, light REAL, pressure INTEGER, timestamp TEXT)")
+    cursor.execute("DROP TABLE IF EXISTS sensor_rollup_minute")
+    cursor.execute("DROP TABLE IF EXISTS sensor_rollup_hour")
+    cursor.execute("DROP TABLE IF EXISTS rollup_watermark")
+    cursor.execute("DROP TABLE IF EXISTS rooms")
+    cursor.execute("DROP TABLE IF EXISTS daily_sleep_summary")
+    cursor.execute("DROP TABLE IF EXISTS worker_state")
+    cursor.execute("DROP TABLE IF EXISTS schema_version")
     conn.commit()
+
+    # Recreate the tables with the same migrations the server runs
+    database.migrate(conn)
     conn.close()
 
 if __name__ == "__main__":
-    drop_database()
-    populate_sleep_sessions()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Fills the database with realistic sensor readings and sleep sessions.")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="database file to write (default: %(default)s)")
+    parser.add_argument("--days", type=int, default=14, help="days of history ending now")
+    parser.add_argument("--rooms", type=int, default=1, help="independent bedrooms to simulate, each in its own database file")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between sensor samples")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for a reproducible database")
+    parser.add_argument("--append", action="store_true", help="keep existing data instead of recreating the tables")
+    args = parser.parse_args()
+
+    end = datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=args.days)
+    rng = np.random.default_rng(args.seed)
+    sensor_rows = session_rows = 0
+    insert_elapsed = 0
+
+    started = time.perf_counter()
+    for number, room in enumerate(room_names(args.rooms)):
+        # Each room gets its own database file, the same one the server uses for it
+        path = database.room_path(args.db, room)
+        if not args.append:
+            drop_database(path)
+
+        conn = database.connect(path)
+        database.migrate(conn)
+        for pragma in BULK_PRAGMAS:
+            conn.execute(pragma)
+
+        room_started = time.perf_counter()
+        rows = populate(conn, rng, start, end, args.interval, offset=number * args.interval / args.rooms)
+        sensor_rows += rows[0]
+        session_rows += rows[1]
+        insert_elapsed += time.perf_counter() - room_started
+
+        with conn:
+            rollups.roll_up(conn)
+            summaries.rebuild(conn)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+
+        database.register_room(args.db, room)
+        print(f"Wrote room {room} to {path}")
+    elapsed = time.perf_counter() - started
+
+    print(f"Inserted {sensor_rows} sensor rows and {session_rows} sleep sessions into {args.rooms} room(s)")
+    print(f"{sensor_rows / insert_elapsed:,.0f} rows/s inserting, {elapsed:.1f}s total including rollups and summaries")
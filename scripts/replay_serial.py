@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from benchmark import ROOT, free_port, percentile, start_server
+from virtual_device import BAUD_RATE, SEND_INTERVAL, VirtualDevice, parse_log, synthetic_log
+
+POLL_INTERVAL = 0.002  # seconds
+# How far ahead of the last matched reading a committed row is looked for before it is set aside
+MATCH_LOOKAHEAD = 1000
+
+class CommitWatcher:
+    """Polls the server's database for new rows and notes when each one became visible, i.e. was committed."""
+
+    def __init__(self, db_path, interval=POLL_INTERVAL):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.interval = interval
+        self.last_id = 0
+        # (time seen, (temperature, light, pressure)), in id order
+        self.rows = []
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def poll(self):
+        rows = self.conn.execute("SELECT id, temperature, light, pressure FROM sensor_data WHERE id > ? ORDER BY id",
+                                 (self.last_id,)).fetchall()
+        seen_at = time.time()
+        for row_id, temperature, light, pressure in rows:
+            self.rows.append((seen_at, reading_key(temperature, light, pressure)))
+            self.last_id = row_id
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self.poll()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.poll()
+        self.conn.close()
+
+def reading_key(temperature, light, pressure):
+    return (None if temperature is None else round(temperature, 2),
+            None if light is None else round(light, 2),
+            None if pressure is None else int(pressure))
+
+def match_rows(emitted, rows, lookahead=MATCH_LOOKAHEAD):
+    """Pairs committed rows with the readings the device wrote; returns the latencies and the rows that matched nothing.
+
+    Rows are matched in order, skipping readings that never arrived. Rows that arrive
+    out of order, e.g. replayed from the client's spool, are matched to any reading
+    still unpaired afterwards.
+    """
+    keys = [reading_key(reading["temp"], reading["light"], reading["pressure"]) for _, reading in emitted]
+    paired = [False] * len(emitted)
+    latencies = []
+    late = []
+    position = 0
+    for seen_at, key in rows:
+        for index in range(position, min(position + lookahead, len(keys))):
+            if keys[index] == key:
+                break
+        else:
+            late.append((seen_at, key))
+            continue
+        paired[index] = True
+        latencies.append(seen_at - emitted[index][0])
+        position = index + 1
+
+    unpaired = {}
+    for index in range(len(keys)):
+        if not paired[index]:
+            unpaired.setdefault(keys[index], []).append(index)
+    unmatched = 0
+    for seen_at, key in late:
+        if unpaired.get(key):
+            latencies.append(seen_at - emitted[unpaired[key].pop(0)][0])
+        else:
+            unmatched += 1
+    return latencies, unmatched
+
+def summarize(emitted, latencies, unmatched, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "emitted": len(emitted),
+        "committed": len(latencies),
+        "dropped": len(emitted) - len(latencies),
+        "unmatched_rows": unmatched,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replays serial output through a virtual Arduino, client.py and a scratch server, "
+                    "and reports latency from emitted line to committed row and any dropped readings.",
+        epilog="Arguments after -- are passed to client.py, e.g. -- --batch --binary. "
+               "Server settings such as SMART_BEDROOM_WRITE_BEHIND=1 are taken from the environment.")
+    parser.add_argument("--log", help="recorded serial output, one line each, optionally prefixed with seconds and a tab "
+                                      "(default: generated readings)")
+    parser.add_argument("--samples", type=int, default=200, help="generated readings to send when there is no log")
+    parser.add_argument("--interval", type=float, default=SEND_INTERVAL, help="seconds between generated readings")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed-up, e.g. 10 (0 for as fast as the link allows)")
+    parser.add_argument("--baud", type=int, default=BAUD_RATE, help="emulated serial link speed (0 for no limit)")
+    parser.add_argument("--drain", type=float, default=15, help="seconds to wait for the last readings to be committed")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for generated readings")
+    parser.add_argument("--client-log", default=os.devnull, help="file for client.py's output")
+    parser.add_argument("--output", help="file to write machine-readable results to")
+    parser.add_argument("client_args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    client_args = args.client_args[1:] if args.client_args[:1] == ["--"] else args.client_args
+
+    log = parse_log(args.log) if args.log else list(synthetic_log(args.samples, args.interval, args.seed))
+    scratch = tempfile.TemporaryDirectory()
+    db_path = os.path.join(scratch.name, "replay.db")
+    server = client = device = watcher = None
+    try:
+        server, base_url = start_server(db_path, free_port())
+        watcher = CommitWatcher(db_path)
+        watcher.thread.start()
+        device = VirtualDevice(log, args.speed, args.baud)
+        device.start()
+
+        with open(args.client_log, "w") as client_output:
+            client = subprocess.Popen([sys.executable, os.path.join(ROOT, "client.py"), "--port", device.port, "--server", base_url,
+                                       "--spool", os.path.join(scratch.name, "spool.jsonl")] + client_args,
+                                      cwd=scratch.name, stdout=client_output, stderr=subprocess.STDOUT)
+            print(f"Replaying {len(log)} lines at {args.speed or 'full'}x through {device.port} -> client.py {' '.join(client_args)} -> {base_url}...")
+
+            if not device.connected.wait(30):
+                raise RuntimeError("client.py never talked to the virtual device")
+            started = time.time()
+            device.finished.wait()
+            deadline = time.time() + args.drain
+            while time.time() < deadline and len(watcher.rows) < len(device.emitted):
+                time.sleep(0.1)
+            elapsed = (watcher.rows[-1][0] if watcher.rows else time.time()) - started
+
+            # Ctrl+C lets the client flush its batch buffer before exiting
+            client.send_signal(signal.SIGINT)
+            try:
+                client.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                client.kill()
+    finally:
+        if client is not None and client.poll() is None:
+            client.kill()
+        if watcher is not None:
+            watcher.close()
+        if device is not None:
+            device.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+        scratch.cleanup()
+
+    latencies, unmatched = match_rows(device.emitted, watcher.rows)
+    results = summarize(device.emitted, latencies, unmatched, elapsed)
+    print(f"Emitted {results['emitted']} readings, {results['committed']} committed, {results['dropped']} dropped, "
+          f"{results['unmatched_rows']} unexpected rows ({results['throughput_rps']} rows/s)")
+    if latencies:
+        print(f"End-to-end latency, line written to row committed: mean {results['mean_ms']} ms, p50 {results['p50_ms']} ms, "
+              f"p95 {results['p95_ms']} ms, p99 {results['p99_ms']} ms, max {results['max_ms']} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "run_at": datetime.now().isoformat(timespec="seconds"),
+                "config": dict(vars(args), client_args=client_args),
+                "results": results,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,34 @@
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import database
+import scoring
+
+DEFAULT_DB_PATH = os.environ.get("SMART_BEDROOM_DB", os.path.join(ROOT, "smart_bedroom.db"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recomputes the quality of every room's finished sleep sessions.")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="main database file; every room's file is re-scored (default: %(default)s)")
+    parser.add_argument("--thresholds", help="JSON file with scoring thresholds (defaults are used for missing keys)")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="sessions scored per transaction")
+    args = parser.parse_args()
+
+    try:
+        thresholds = scoring.load_thresholds(args.thresholds)
+    except ValueError as e:
+        parser.error(f"invalid thresholds: {e}")
+    for room in database.list_rooms(args.db):
+        path = database.room_path(args.db, room)
+        conn = database.connect(path)
+        database.migrate(conn)
+
+        started = time.perf_counter()
+        scored, changed = scoring.rescore_sessions(conn, thresholds, args.chunk_size)
+        elapsed = time.perf_counter() - started
+        conn.close()
+
+        print(f"{path}: re-scored {scored} sessions ({changed} changed) in {elapsed:.2f}s")
@@ -0,0 +1,206 @@
+import argparse
+import os
+import random
+import select
+import sys
+import threading
+import time
+import tty
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import serial_protocol
+
+# The sketch's text-mode send interval, used to space log lines that carry no time
+SEND_INTERVAL = 2.0  # seconds
+BAUD_RATE = 9600
+
+def parse_reading(line):
+    """The reading in a "temp:...,light:...,pressure:..." line, as client.py parses it, or None."""
+    try:
+        data = {}
+        for pair in line.strip().split(","):
+            key, value = pair.split(":")
+            data[key] = float(value)
+    except ValueError:
+        return None
+    if set(data) != {"temp", "light", "pressure"}:
+        return None
+    return data
+
+def parse_log(path, interval=SEND_INTERVAL):
+    """Recorded serial output as (seconds since the first line, line) pairs.
+
+    A line may start with its time in seconds and a tab, e.g. "12.5\\ttemp:20.31,light:40.00,pressure:1";
+    lines without one follow the previous line after `interval` seconds.
+    """
+    log = []
+    offset = -interval
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            stamp, tab, rest = line.partition("\t")
+            try:
+                offset, line = float(stamp) if tab else offset + interval, rest if tab else line
+            except ValueError:
+                offset += interval
+            log.append((offset, line))
+    start = log[0][0] if log else 0
+    return [(offset - start, line) for offset, line in log]
+
+def synthetic_log(samples=0, interval=SEND_INTERVAL, seed=None):
+    """Lines like the sketch prints: drifting temperature and light, in bed in long runs (samples=0 runs forever)."""
+    rng = random.Random(seed)
+    temp, light, pressure = 20.0, 30.0, 1
+    count = 0
+    while not samples or count < samples:
+        temp = min(max(temp + rng.uniform(-0.1, 0.1), 15), 28)
+        light = min(max(light + rng.uniform(-2, 2), 0), 100)
+        if rng.random() < 0.02:
+            pressure = 1 - pressure
+        yield count * interval, f"temp:{temp:.2f},light:{light:.2f},pressure:{pressure}"
+        count += 1
+
+class VirtualDevice:
+    """Stands in for the Arduino on a pseudo-terminal that client.py opens like a serial port.
+
+    Writes the sketch's output, text lines or binary records once asked for MODE:BIN,
+    on the schedule of a log divided by `speed`, and handles the commands the sketch
+    understands. Bytes are paced at `baud` like the real link (0 for no limit).
+    """
+
+    def __init__(self, log, speed=1.0, baud=BAUD_RATE):
+        self.log = log
+        self.speed = speed
+        self.baud = baud
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.booted = time.monotonic()
+        self.binary = False
+        self.sequence = 0
+        self.preferences = None
+        # (time written, reading as the client will decode it), in order
+        self.emitted = []
+        self.connected = threading.Event()
+        self.finished = threading.Event()
+        self.stopped = threading.Event()
+        self.write_lock = threading.Lock()
+
+    def start(self, connect_timeout=30):
+        """Starts answering commands and, once the client has sent its first one, replaying the log."""
+        threading.Thread(target=self._read_commands, daemon=True).start()
+        threading.Thread(target=self._replay, args=(connect_timeout,), daemon=True).start()
+
+    def close(self):
+        self.stopped.set()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _write(self, data):
+        with self.write_lock:
+            os.write(self.master, data)
+            if self.baud:
+                # 8N1: 10 bits per byte
+                time.sleep(len(data) * 10 / self.baud)
+
+    def _read_commands(self):
+        pending = b""
+        while not self.stopped.is_set():
+            try:
+                ready, _, _ = select.select([self.master], [], [], 0.2)
+                if not ready:
+                    continue
+                pending += os.read(self.master, 1024)
+            except OSError:
+                return
+            while b"\n" in pending:
+                line, _, pending = pending.partition(b"\n")
+                self.handle_command(line.decode("utf-8", errors="replace").strip())
+
+    def handle_command(self, command):
+        if not command:
+            return
+        if command.startswith("PREFS:"):
+            # Same layout the sketch parses: ideal_temp,max_light,adaptive_light,auto_temp
+            try:
+                ideal_temp, max_light, adaptive_light, auto_temp = command[len("PREFS:"):].split(",")
+                self.preferences = {
+                    "ideal_temp": float(ideal_temp),
+                    "max_light": int(float(max_light)),
+                    "adaptive_light": int(adaptive_light) == 1,
+                    "auto_temp": int(auto_temp) == 1,
+                }
+                print(f"Device got preferences: {self.preferences}")
+            except ValueError:
+                print(f"Device ignored malformed preferences: {command}")
+        elif command == "MODE:BIN":
+            self._write((serial_protocol.BINARY_ACK + "\r\n").encode())
+            self.binary = True
+            self.sequence = 0
+        elif command == "MODE:TEXT":
+            self.binary = False
+        # The replay starts on the client's first command, after any mode switch is in place
+        self.connected.set()
+
+    def emit(self, line):
+        reading = parse_reading(line)
+        if self.binary:
+            if reading is None:
+                return  # the sketch keeps debug output off the line in binary mode
+            millis = int((time.monotonic() - self.booted) * 1000)
+            data = serial_protocol.encode_frame(self.sequence, millis, reading["temp"], reading["light"], reading["pressure"])
+            self.sequence += 1
+            # What the client decodes from the record
+            reading = {"temp": round(reading["temp"] * 100) / 100, "light": float(round(reading["light"])),
+                       "pressure": float(int(reading["pressure"]))}
+        else:
+            data = (line + "\r\n").encode()
+
+        written_at = time.time()
+        self._write(data)
+        if reading is not None:
+            self.emitted.append((written_at, reading))
+
+    def _replay(self, connect_timeout):
+        self.connected.wait(connect_timeout)
+        started = time.monotonic()
+        try:
+            for offset, line in self.log:
+                if self.stopped.is_set():
+                    break
+                if self.speed:
+                    delay = started + offset / self.speed - time.monotonic()
+                    if delay > 0:
+                        self.stopped.wait(delay)
+                self.emit(line)
+        except OSError:
+            pass
+        finally:
+            self.finished.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulates the Arduino on a pseudo-terminal so client.py can run without hardware.")
+    parser.add_argument("--log", help="recorded serial output to replay (default: generated readings, forever)")
+    parser.add_argument("--samples", type=int, default=0, help="generated readings to send (0 for no limit)")
+    parser.add_argument("--interval", type=float, default=SEND_INTERVAL, help="seconds between generated readings")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed-up (0 for as fast as the link allows)")
+    parser.add_argument("--baud", type=int, default=BAUD_RATE, help="emulated link speed (0 for no limit)")
+    parser.add_argument("--seed", type=int, help="random seed for generated readings")
+    args = parser.parse_args()
+
+    log = parse_log(args.log) if args.log else synthetic_log(args.samples, args.interval, args.seed)
+    device = VirtualDevice(log, args.speed, args.baud)
+    device.start(connect_timeout=None)
+    print(f"Virtual Arduino on {device.port}; run: python3 client.py --port {device.port}")
+    try:
+        while not device.finished.wait(1):
+            pass
+        print(f"Sent {len(device.emitted)} readings")
+    except KeyboardInterrupt:
+        print(f"Stopping after {len(device.emitted)} readings...")
+    finally:
+        device.close()
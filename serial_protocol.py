@@ -0,0 +1,96 @@
+import struct
+
+# Binary mode is requested by the client right after connecting; the sketch answers
+# BINARY_ACK and from then on sends FRAME records instead of "temp:...,light:..." lines.
+BINARY_REQUEST = b"MODE:BIN\n"
+BINARY_ACK = "ACK:BIN"
+
+# Little-endian, as the AVR lays it out:
+# sync (0xAA 0x55), sequence, board millis, temperature in centi-degrees, light %, pressure, CRC-8
+SYNC = b"\xaa\x55"
+FRAME = struct.Struct("<2sHIhBBB")
+# The CRC covers everything between the sync bytes and the CRC itself
+CRC_START, CRC_END = len(SYNC), FRAME.size - 1
+
+
+def _crc8_table(poly=0x07):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def encode_frame(sequence, millis, temperature, light, pressure):
+    """One binary record, byte for byte what the sketch writes."""
+    frame = bytearray(FRAME.pack(SYNC, sequence & 0xFFFF, millis & 0xFFFFFFFF,
+                                 round(temperature * 100), int(max(0, min(255, light))), int(pressure), 0))
+    frame[-1] = crc8(frame[CRC_START:CRC_END])
+    return bytes(frame)
+
+
+class FrameDecoder:
+    """Turns a byte stream of binary records back into readings.
+
+    Bytes can arrive in any chunking. A record that fails its CRC is skipped by
+    searching for the next sync pattern, and gaps in the sequence numbers are
+    counted as dropped records.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.last_sequence = None
+        self.received = 0
+        self.dropped = 0
+        self.corrupted = 0
+
+    def feed(self, data):
+        self.buffer += data
+        readings = []
+        view = memoryview(self.buffer)
+        position = 0
+        try:
+            while True:
+                start = self.buffer.find(SYNC, position)
+                if start < 0:
+                    # Keep a trailing 0xAA that may be the first half of the next sync
+                    position = len(self.buffer) - (1 if self.buffer.endswith(SYNC[:1]) else 0)
+                    break
+                if len(self.buffer) - start < FRAME.size:
+                    position = start
+                    break
+
+                _, sequence, millis, temperature, light, pressure, checksum = FRAME.unpack_from(view, start)
+                if crc8(view[start + CRC_START:start + CRC_END]) != checksum:
+                    self.corrupted += 1
+                    position = start + 1
+                    continue
+
+                if self.last_sequence is not None:
+                    self.dropped += (sequence - self.last_sequence - 1) & 0xFFFF
+                self.last_sequence = sequence
+                self.received += 1
+                readings.append({
+                    "temp": temperature / 100,
+                    "light": float(light),
+                    "pressure": float(pressure),
+                    "sequence": sequence,
+                    "millis": millis,
+                })
+                position = start + FRAME.size
+        finally:
+            view.release()
+        del self.buffer[:position]
+        return readings
@@ -1,72 +1,425 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
-import sqlite3
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, g
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import atexit
+import json
+import math
 import os
+import queue
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import time
+
+import archive
+import database
+import deadband
+import metrics
+import rollups
+import scoring
+import summaries
+import timestamps
+from sessions import SessionDetector, session_averages
+from writebehind import WriteBehindQueue
+from state import EventBroker, LatestState
 
 app = Flask(__name__, static_folder='static')
+app.config["DATABASE"] = database.DB_PATH
+# Raw readings older than this are deleted once rolled up (0 keeps them forever)
+app.config["RETENTION_DAYS"] = int(os.environ.get("SMART_BEDROOM_RETENTION_DAYS", 30))
+# Minute rollups older than this are deleted, leaving the hourly ones (0 keeps them forever)
+app.config["MINUTE_ROLLUP_RETENTION_DAYS"] = int(os.environ.get("SMART_BEDROOM_MINUTE_ROLLUP_RETENTION_DAYS", 90))
+RETENTION_CHECK_INTERVAL = 3600  # seconds
+# Sleep quality thresholds, optionally overridden by a JSON file
+app.config["SCORING_THRESHOLDS"] = scoring.load_thresholds(os.environ.get("SMART_BEDROOM_SCORING"))
+# Seconds the bed has to stay occupied before a session opens, and empty before it closes;
+# sessions shorter than the minimum are dropped
+app.config["SESSION_START_DELAY"] = float(os.environ.get("SMART_BEDROOM_SESSION_START_DELAY", 4))
+app.config["SESSION_END_DELAY"] = float(os.environ.get("SMART_BEDROOM_SESSION_END_DELAY", 6))
+app.config["SESSION_MIN_DURATION"] = float(os.environ.get("SMART_BEDROOM_SESSION_MIN_DURATION", 0))
+
+# Set when several server processes share the databases (wsgi.py turns it on). Each worker then
+# hands its session detector state to the others through the database and, before answering,
+# catches its in-memory state up with what the others wrote.
+app.config["SHARED_STATE"] = os.environ.get("SMART_BEDROOM_SHARED_STATE", "0") == "1"
+# How often streams and preference long-polls look for changes made by other workers
+SHARED_STATE_POLL_INTERVAL = 1  # seconds
+
+# Deadband compression: a reading is only stored when temperature or light moved further than
+# its tolerance (degrees C, percent) from the last stored row, occupancy changed, or the
+# heartbeat (seconds) passed; history treats each stored row as holding until the next
+app.config["DEADBAND"] = os.environ.get("SMART_BEDROOM_DEADBAND", "0") == "1"
+app.config["DEADBAND_TEMPERATURE"] = float(os.environ.get("SMART_BEDROOM_DEADBAND_TEMPERATURE", 0.2))
+app.config["DEADBAND_LIGHT"] = float(os.environ.get("SMART_BEDROOM_DEADBAND_LIGHT", 2))
+app.config["DEADBAND_HEARTBEAT"] = float(os.environ.get("SMART_BEDROOM_DEADBAND_HEARTBEAT", 60))
+
+# Write-behind ingestion: sensor routes queue readings and answer 202 right away, and one
+# writer thread commits them in groups of up to WRITE_BEHIND_MAX_BATCH rows every few ms
+app.config["WRITE_BEHIND"] = os.environ.get("SMART_BEDROOM_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_MAX_BATCH = 500
+WRITE_BEHIND_MAX_DELAY = 0.005  # seconds
+write_behind = None
+_write_behind_lock = threading.Lock()
+
+# Room names double as file name suffixes, so keep them to a safe alphabet
+ROOM_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Dashboard-facing state per room, served from memory and updated by the write paths
+room_states = {}
+_room_states_lock = threading.Lock()
+_registered_rooms = set()
+
+# Sleep-session detection state per room, rebuilt from the room's database on first use
+session_detectors = {}
+_session_detectors_lock = threading.Lock()
+# Held while a room's detector is being rebuilt, so other rooms don't wait on its database scan
+_detector_build_locks = {}
+
+# Live updates pushed to /api/stream subscribers
+events = EventBroker()
+STREAM_KEEPALIVE = 15  # seconds
+PREFERENCES_WAIT_TIMEOUT = 30  # seconds
+# Streams and long-polls each hold a worker thread for as long as they stay open, so past this
+# many at once per process they get a 503 and leave the remaining threads to regular requests
+app.config["MAX_LONG_REQUESTS"] = int(os.environ.get("SMART_BEDROOM_MAX_LONG_REQUESTS", 24))
+LONG_REQUEST_RETRY_AFTER = 30  # seconds
+_long_requests = 0
+_long_requests_lock = threading.Lock()
+metrics.LONG_REQUESTS_OPEN.set_function(lambda: _long_requests)
+HISTORY_PAGE_SIZE = 5000
+HISTORY_MAX_PAGE_SIZE = 50000
+
+class InvalidRoom(ValueError):
+    pass
+
+@app.errorhandler(InvalidRoom)
+def invalid_room(error):
+    return jsonify({"error": str(error)}), 400
+
+def get_room(data=None):
+    """Room a request is about: `room` in the JSON body, then the query string, then the default room."""
+    room = data.get("room") if isinstance(data, dict) else None
+    room = room or request.args.get("room") or database.DEFAULT_ROOM
+    if not isinstance(room, str) or not ROOM_PATTERN.match(room):
+        raise InvalidRoom("Invalid room, use letters, digits, '-' and '_' only")
+    return room
+
+def room_db_path(room):
+    path = database.room_path(app.config["DATABASE"], room)
+    if room not in _registered_rooms:
+        database.register_room(app.config["DATABASE"], room)
+        _registered_rooms.add(room)
+    return path
+
+def get_state(room=database.DEFAULT_ROOM):
+    with _room_states_lock:
+        state = room_states.get(room)
+        if state is None:
+            state = room_states[room] = LatestState()
+    if not state.loaded:
+        state.ensure_loaded(lambda: get_db(room))
+        state.set_session(get_detector(room).snapshot())
+    elif app.config["SHARED_STATE"]:
+        refresh_shared_state(room, state)
+    return state
+
+@contextmanager
+def pooled_db(path):
+    """A pooled connection for work outside a request, such as a stream or a background thread."""
+    pool = database.get_pool(path)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def get_detector(room):
+    with _session_detectors_lock:
+        detector = session_detectors.get(room)
+        if detector is not None:
+            return detector
+        build_lock = _detector_build_locks.setdefault(room, threading.Lock())
+    with build_lock:
+        with _session_detectors_lock:
+            detector = session_detectors.get(room)
+        if detector is None:
+            detector = SessionDetector(app.config["SESSION_START_DELAY"], app.config["SESSION_END_DELAY"],
+                                       app.config["SESSION_MIN_DURATION"], scoring_thresholds)
+            with pooled_db(room_db_path(room)) as conn, conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if app.config["SHARED_STATE"]:
+                    detector.resume(conn)
+                else:
+                    detector.rebuild(conn)
+            with _session_detectors_lock:
+                session_detectors[room] = detector
+        return detector
+
+def scoring_thresholds():
+    """Current scoring thresholds, including an override another worker saved through the rescore route."""
+    if app.config["SHARED_STATE"]:
+        with pooled_db(app.config["DATABASE"]) as conn:
+            saved = conn.execute("SELECT scoring_thresholds FROM worker_state").fetchone()[0]
+        if saved:
+            app.config["SCORING_THRESHOLDS"] = json.loads(saved)
+    return app.config["SCORING_THRESHOLDS"]
+
+def refresh_shared_state(room, state):
+    """Catches this worker's view of a room up with what other worker processes committed.
+
+    Returns the session transitions it found, or None when nothing changed.
+    """
+    detector = get_detector(room)
+    with pooled_db(room_db_path(room)) as conn:
+        reading_id, preferences_version, detector_version, summaries_version = conn.execute("""
+            SELECT (SELECT MAX(id) FROM sensor_data),
+                   (SELECT version FROM user_preferences ORDER BY id DESC LIMIT 1),
+                   detector_version, summaries_version
+            FROM worker_state
+        """).fetchone()
+        
+        changed = False
+        if reading_id != state.reading_id:
+            state.load_reading(conn)
+            changed = True
+        if preferences_version != state.preferences_version:
+            state.load_preferences(conn)
+            changed = True
+        if summaries_version != state.summaries_version:
+            state.invalidate_summaries()
+            state.summaries_version = summaries_version
+        
+        before = state.session
+        if detector_version != detector.version:
+            with detector.lock:
+                detector.sync(conn)
+                state.set_session(detector.snapshot())
+            changed = True
+    
+    if not changed:
+        return None
+    after = state.session
+    moved_on = before is not None and (after is None or after["id"] != before["id"])
+    return {"session_started": after is not None and (before is None or moved_on), "session_ended": moved_on}
+
+@contextmanager
+def ingestion_transaction(room):
+    """The room's session detector and a transaction on its database, held by one writer at a time.
 
-def adapt_datetime(dt):
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
+    The transaction takes SQLite's write lock up front, so no other thread or process can
+    open or close a session between the detector's decision and its write. If it fails the
+    detector may be ahead of the database, so it is dropped and rebuilt on next use.
+    """
+    detector = get_detector(room)
+    with detector.lock:
+        try:
+            with get_db(room) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if app.config["SHARED_STATE"]:
+                    detector.sync(conn)
+                yield detector, conn
+                if app.config["SHARED_STATE"]:
+                    detector.save(conn)
+        except Exception:
+            with _session_detectors_lock:
+                session_detectors.pop(room, None)
+            raise
+
+def cached_json(payload, state):
+    """JSON response that answers a repeated poll with 304 when nothing changed."""
+    response = jsonify(payload)
+    response.add_etag()
+    response.last_modified = state.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def get_db(room=database.DEFAULT_ROOM):
+    """Returns this request's pooled connection to a room's database, checking one out on first use."""
+    if "dbs" not in g:
+        g.dbs = {}
+    if room not in g.dbs:
+        g.dbs[room] = database.get_pool(room_db_path(room)).acquire()
+    return g.dbs[room]
+
+@app.teardown_appcontext
+def release_db(exception):
+    for room, conn in g.pop("dbs", {}).items():
+        database.get_pool(database.room_path(app.config["DATABASE"], room)).release(conn)
+
+if metrics.ENABLED:
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            # The route pattern rather than the path, so /sounds/<id> stays one series
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - started, request.method, route, response.status_code)
+        return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Request, SQL and ingestion metrics in the Prometheus text format."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 # Database setup
 def init_db():
+    """Opens the database pool up front so migrations run at startup instead of on the first request."""
+    database.get_pool(app.config["DATABASE"])
 
-    sqlite3.register_adapter(datetime, adapt_datetime)
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        
-        # Create sensor data table
-        cursor.execute('''CREATE TABLE IF NOT EXISTS sensor_data (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            temperature REAL,
-                            light REAL,
-                            pressure INTEGER,
-                            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        
-        # Create sleep sessions table
-        cursor.execute('''CREATE TABLE IF NOT EXISTS sleep_sessions (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            start_time DATETIME,
-                            end_time DATETIME,
-                            duration_minutes INTEGER,
-                            avg_temperature REAL,
-                            avg_light REAL,
-                            quality TEXT)''')
-        
-        # Create user preferences table
-        cursor.execute('''CREATE TABLE IF NOT EXISTS user_preferences (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            ideal_temp REAL DEFAULT 18.5,
-                            max_light INTEGER DEFAULT 50,
-                            adaptive_light BOOLEAN DEFAULT 1,
-                            auto_temp BOOLEAN DEFAULT 1,
-                            sleep_notifications BOOLEAN DEFAULT 1,
-                            sound_id TEXT DEFAULT 'white-noise',
-                            sound_duration INTEGER DEFAULT 30)''')
-        
-        # Insert default preferences if not exists
-        cursor.execute("SELECT COUNT(*) FROM user_preferences")
-        if cursor.fetchone()[0] == 0:
-            cursor.execute("INSERT INTO user_preferences DEFAULT VALUES")
-        
-        conn.commit()
+# Registered before the write-behind queue's close, so it runs after the queue is drained
+atexit.register(database.close_pools)
+
+def invalid_sensor_value(data):
+    """The first of temp, light and pressure that is neither a finite number nor null, or None.
 
-init_db()
+    Checked before a reading is acknowledged, so the writer never meets a value it can't store.
+    """
+    for key in ("temp", "light", "pressure"):
+        value = data.get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return key
+    return None
 
-def insert_sensor_data(data):
-    # Register the datetime adapter for this connection
-    sqlite3.register_adapter(datetime, adapt_datetime)
+def parse_reading_time(value):
+    """Accepts a reading's capture time as epoch seconds or a "%Y-%m-%d %H:%M:%S" string, optionally with fractions of a second.
     
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute("INSERT INTO sensor_data (temperature, light, pressure, timestamp) VALUES (?, ?, ?, ?)",
-                       (data.get("temp"), data.get("light"), data.get("pressure"), current_time))
-        conn.commit()
+    Readings without one are stamped on arrival, and a device clock running ahead of
+    ours is capped at the current time.
+    """
+    now = datetime.now()
+    if value is None:
+        return now
+    if isinstance(value, (int, float)):
+        return min(datetime.fromtimestamp(value), now)
+    return min(timestamps.parse(value), now)
+
+def insert_sensor_data(data, room, reading_time):
+    state = get_state(room)
+    with ingestion_transaction(room) as (detector, conn):
+        stored, last_id = insert_readings(conn, [dict(data, time=reading_time)])
         
         # Check if we need to update sleep sessions
-        return update_sleep_sessions(conn, data)
-    return False
+        result = detector.observe(conn, data, timestamps.to_ms(reading_time))
+        session = detector.snapshot()
+        rollups.roll_up(conn)
+    
+    count_ingestion(room, stored, int(result["session_started"]), int(result["session_ended"]), skipped=1 - stored)
+    schedule_retention(room)
+    newer = state.set_reading(data.get("temp"), data.get("light"), data.get("pressure"), timestamps.to_ms(reading_time), last_id)
+    refresh_session_state(state, session, result)
+    publish_updates(room, result, reading=newer)
+    return result
+
+def insert_readings(conn, readings):
+    """Inserts readings in time order, minus those deadband compression leaves out.
+
+    Returns how many rows were stored and the id of the newest stored row, which is
+    the one the latest reading falls back to when it was left out.
+    """
+    if app.config["DEADBAND"]:
+        band = deadband.Deadband(app.config["DEADBAND_TEMPERATURE"], app.config["DEADBAND_LIGHT"],
+                                 app.config["DEADBAND_HEARTBEAT"])
+        readings = band.filter(deadband.last_stored(conn), readings)
+    if readings:
+        conn.executemany("INSERT INTO sensor_data (temperature, light, pressure, timestamp) VALUES (?, ?, ?, ?)",
+                         [(r.get("temp"), r.get("light"), r.get("pressure"), r["time"]) for r in readings])
+    return len(readings), conn.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0]
+
+def count_ingestion(room, samples, sessions_started, sessions_ended, skipped=0):
+    metrics.SAMPLES_INGESTED.inc(room, amount=samples)
+    if skipped:
+        metrics.SAMPLES_SKIPPED.inc(room, amount=skipped)
+    if sessions_started:
+        metrics.SESSIONS_STARTED.inc(room, amount=sessions_started)
+    if sessions_ended:
+        metrics.SESSIONS_ENDED.inc(room, amount=sessions_ended)
+
+_last_retention_run = {}
+_retention_lock = threading.Lock()
+
+def schedule_retention(room):
+    """Starts a background prune of a room's old raw readings and minute rollups at most once per RETENTION_CHECK_INTERVAL."""
+    retention_days = app.config["RETENTION_DAYS"]
+    minute_retention_days = app.config["MINUTE_ROLLUP_RETENTION_DAYS"]
+    if not (retention_days or minute_retention_days) or time.time() - _last_retention_run.get(room, 0) < RETENTION_CHECK_INTERVAL:
+        return
+    if not _retention_lock.acquire(blocking=False):
+        return
+    _last_retention_run[room] = time.time()
+    threading.Thread(target=run_retention, args=(room_db_path(room), retention_days, minute_retention_days),
+                     daemon=True).start()
+
+def run_retention(path, retention_days, minute_retention_days):
+    try:
+        with pooled_db(path) as conn:
+            if retention_days:
+                deleted = rollups.prune_raw_data(conn, retention_days)
+                print(f"Pruned {deleted} raw sensor readings older than {retention_days} days")
+            if minute_retention_days:
+                deleted = rollups.prune_minute_rollups(conn, minute_retention_days)
+                print(f"Pruned {deleted} minute rollups older than {minute_retention_days} days")
+    finally:
+        _retention_lock.release()
+
+_last_conditions = {}
+
+def publish_updates(room, result, reading=True):
+    """Pushes the latest reading, any session transition and changed optimal conditions to the room's stream subscribers.
+
+    Pass reading=False when the ingested readings were all older than the latest one.
+    """
+    state = room_states[room]
+    if reading:
+        events.publish("reading", current_data_payload(state), room)
+    
+    if result["session_started"]:
+        events.publish("session", {"event": "started", "start_time": state.session and timestamps.format_ms(state.session["start_time"])}, room)
+    if result["session_ended"]:
+        events.publish("session", {"event": "ended"}, room)
+    
+    conditions = optimal_conditions_payload(state)
+    if conditions != _last_conditions.get(room):
+        _last_conditions[room] = conditions
+        events.publish("conditions", conditions, room)
+
+def refresh_session_state(state, session, result):
+    if result["session_ended"]:
+        state.invalidate_summaries()
+    state.set_session(session)
+
+def insert_sensor_batch(readings, room):
+    """Stores one room's readings in one transaction and runs session detection over them in order."""
+    readings = sorted(readings, key=lambda reading: reading["time"])
+    result = {"session_started": False, "session_ended": False}
+    state = get_state(room)
+
+    with ingestion_transaction(room) as (detector, conn):
+        stored, last_id = insert_readings(conn, readings)
+
+        started = ended = 0
+        for reading in readings:
+            status = detector.observe(conn, reading, timestamps.to_ms(reading["time"]))
+            started += status["session_started"]
+            ended += status["session_ended"]
+        result["session_started"], result["session_ended"] = started > 0, ended > 0
+        session = detector.snapshot()
+        rollups.roll_up(conn)
+    
+    count_ingestion(room, stored, started, ended, skipped=len(readings) - stored)
+    schedule_retention(room)
+    last = readings[-1]
+    newer = state.set_reading(last.get("temp"), last.get("light"), last.get("pressure"), timestamps.to_ms(last["time"]), last_id)
+    refresh_session_state(state, session, result)
+    publish_updates(room, result, reading=newer)
+    return result
 
 
 @app.route("/sounds/<sound_id>.mp3")
@@ -82,99 +435,6 @@ def serve_sound(sound_id):
     
     return send_from_directory(sound_dir, f"{sound_id}.mp3")
 
-def update_sleep_sessions(conn, data):
-    cursor = conn.cursor()
-    pressure = data.get("pressure", 0)
-    
-    # Get the last sleep session that doesn't have an end time
-    cursor.execute("SELECT id, start_time FROM sleep_sessions WHERE end_time IS NULL")
-    active_session = cursor.fetchone()
-
-    result = {"session_started": False, "session_ended": False}
-    
-    # User is in bed
-    if pressure > 0:
-        if not active_session:
-            print('Comecou uma sessao')
-            cursor.execute("INSERT INTO sleep_sessions (start_time) VALUES (?)", 
-                          (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
-            conn.commit()
-            result["session_started"] = True
-    else:  # User is not in bed
-        if active_session:
-            print('acabou uma sessao')
-            # End the active sleep session
-            session_id, start_time = active_session
-            end_time = datetime.now()
-            start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
-            
-            # Each second is a minute
-            duration = ((end_time - start_time).total_seconds())*5
-            
-            # Calculate averages for this session
-            cursor.execute("""
-                SELECT AVG(temperature), AVG(light) FROM sensor_data 
-                WHERE timestamp BETWEEN ? AND ?
-            """, (start_time.strftime("%Y-%m-%d %H:%M:%S"), end_time.strftime("%Y-%m-%d %H:%M:%S")))
-            
-            avg_temp, avg_light = cursor.fetchone()
-            
-            # Determine sleep quality
-            if avg_temp is not None and avg_light is not None:
-                quality = determine_sleep_quality(avg_temp, avg_light, duration)
-            else:
-                quality = "Unknown"
-            
-            # Update the session
-            cursor.execute("""
-                UPDATE sleep_sessions 
-                SET end_time = ?, duration_minutes = ?, avg_temperature = ?, avg_light = ?, quality = ?
-                WHERE id = ?
-            """, (end_time.strftime("%Y-%m-%d %H:%M:%S"), round(duration), avg_temp, avg_light, quality, session_id))
-            
-            conn.commit()
-            result["session_ended"] = True
-    return result
-
-def determine_sleep_quality(avg_temp, avg_light, duration):
-
-    quality_score = 0
-    
-    # Temperature factor (18-22°C is ideal)
-    if 18 <= avg_temp <= 22:
-        quality_score += 3
-    elif 16 <= avg_temp < 18 or 22 < avg_temp <= 24:
-        quality_score += 2
-    else:
-        quality_score += 1
-    
-    # Light factor (0-15% is ideal)
-    if 0 <= avg_light <= 15:
-        quality_score += 3
-    elif 15 < avg_light <= 30:
-        quality_score += 2
-    else:
-        quality_score += 1
-    
-    # Duration factor (7-9 hours is ideal)
-    duration_hours = duration / 60
-    if 7 <= duration_hours <= 9:
-        quality_score += 3
-    elif 6 <= duration_hours < 7 or 9 < duration_hours <= 10:
-        quality_score += 2
-    else:
-        quality_score += 1
-    
-    # Convert score to quality
-    if quality_score >= 8:
-        return "Excellent"
-    elif quality_score >= 6:
-        return "Good"
-    elif quality_score >= 4:
-        return "Fair"
-    else:
-        return "Poor"
-
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -190,46 +450,334 @@ def receive_sensor_data():
     if not data:
         return jsonify({"error": "Invalid data"}), 400
     
+    try:
+        reading_time = parse_reading_time(data.get("timestamp"))
+    except (AttributeError, TypeError, ValueError, OverflowError, OSError):
+        return jsonify({"error": "Invalid timestamp"}), 400
+    
+    invalid = invalid_sensor_value(data)
+    if invalid:
+        return jsonify({"error": f"Invalid {invalid}, expected a number or null"}), 400
+    
     print(f"Received sensor data: {data}")
     
-    session_status = insert_sensor_data(data)
+    room = get_room(data)
+    if app.config["WRITE_BEHIND"]:
+        return queue_readings([(room, dict(data, time=reading_time))])
+    
+    session_status = insert_sensor_data(data, room, reading_time)
+    return jsonify({
+        "message": "Data received successfully",
+        "room": room,
+        "session_started": session_status["session_started"],
+        "session_ended": session_status["session_ended"]
+    }), 200
+
+@app.route("/api/sensor-data/batch", methods=["POST"])
+def receive_sensor_batch():
+    """Receives a list of timestamped readings buffered by the client."""
+    data = request.get_json()
+    if not isinstance(data, list) or not data:
+        return jsonify({"error": "Invalid data"}), 400
+
+    try:
+        readings = [dict(reading, time=parse_reading_time(reading.get("timestamp"))) for reading in data]
+    except (AttributeError, TypeError, ValueError, OverflowError, OSError):
+        return jsonify({"error": "Invalid timestamp"}), 400
+
+    for index, reading in enumerate(readings):
+        invalid = invalid_sensor_value(reading)
+        if invalid:
+            return jsonify({"error": f"Invalid {invalid} in reading {index}, expected a number or null"}), 400
+
+    print(f"Received batch of {len(readings)} readings")
+
+    if app.config["WRITE_BEHIND"]:
+        return queue_readings([(get_room(reading), reading) for reading in readings])
+    
+    session_status = store_readings([(get_room(reading), reading) for reading in readings])
     return jsonify({
         "message": "Data received successfully",
+        "count": len(readings),
         "session_started": session_status["session_started"],
         "session_ended": session_status["session_ended"]
     }), 200
 
+def store_readings(room_readings):
+    """Stores (room, reading) pairs; each room's readings go to its own database in their own transaction."""
+    by_room = {}
+    for room, reading in room_readings:
+        by_room.setdefault(room, []).append(reading)
+    
+    session_status = {"session_started": False, "session_ended": False}
+    for room, readings in by_room.items():
+        status = insert_sensor_batch(readings, room)
+        session_status["session_started"] |= status["session_started"]
+        session_status["session_ended"] |= status["session_ended"]
+    return session_status
+
+def write_queued_readings(room_readings):
+    # Runs on the writer thread, outside any request. Rooms already stored are taken out of
+    # the group, so a retry after another room's database failed doesn't store them twice.
+    with app.app_context():
+        for room in list(dict.fromkeys(room for room, _ in room_readings)):
+            insert_sensor_batch([reading for each, reading in room_readings if each == room], room)
+            room_readings[:] = [item for item in room_readings if item[0] != room]
+
+def get_write_behind():
+    """The write-behind queue, starting its writer thread on first use."""
+    global write_behind
+    with _write_behind_lock:
+        if write_behind is None:
+            write_behind = WriteBehindQueue(write_queued_readings, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_MAX_DELAY,
+                                            on_group=metrics.WRITE_BEHIND_GROUP_SIZE.observe,
+                                            transient=(sqlite3.OperationalError,))
+            metrics.WRITE_BEHIND_DEPTH.set_function(write_behind.depth)
+            # Commit whatever is still queued when the server shuts down
+            atexit.register(write_behind.close)
+        return write_behind
+
+def queue_readings(room_readings):
+    try:
+        get_write_behind().put_many(room_readings)
+    except queue.Full:
+        return jsonify({"error": "Ingestion queue full, retry later"}), 503
+    return jsonify({
+        "message": "Data queued",
+        "count": len(room_readings)
+    }), 202
+
+@app.route("/api/rooms", methods=["GET"])
+def get_rooms():
+    return jsonify(database.list_rooms(app.config["DATABASE"]))
+
 @app.route("/api/current-data", methods=["GET"])
 def get_current_data():
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        
-        # Get latest sensor data
-        cursor.execute("SELECT temperature, light, pressure, timestamp FROM sensor_data ORDER BY id DESC LIMIT 1")
-        sensor_row = cursor.fetchone()
-        
-        # Get active sleep session if any
-        cursor.execute("SELECT start_time FROM sleep_sessions WHERE end_time IS NULL")
-        active_session = cursor.fetchone()
+    state = get_state(get_room())
+    return cached_json(current_data_payload(state), state)
+
+def current_data_payload(state):
+    sensor_row = state.reading
+    active_session = state.session
+    
+    if sensor_row:
+        data = dict(sensor_row, sleeping=active_session is not None)
         
-        if sensor_row:
-            data = {
-                "temperature": sensor_row[0],
-                "light": sensor_row[1],
-                "pressure": sensor_row[2],
-                "timestamp": sensor_row[3],
-                "sleeping": active_session is not None
+        # If sleeping, calculate current duration
+        if active_session:
+            current_duration = (timestamps.to_ms(datetime.now()) - active_session["start_time"]) / 60000
+            data["current_sleep_duration"] = round(current_duration)
+            
+            avg_temp, avg_light = session_averages(active_session["sample_count"], active_session["temp_sum"], active_session["light_sum"])
+            data["session"] = {
+                "avg_temperature": round(avg_temp, 1) if avg_temp is not None else None,
+                "avg_light": round(avg_light, 1) if avg_light is not None else None,
+                "min_temperature": active_session["min_temperature"],
+                "max_temperature": active_session["max_temperature"],
+                "min_light": active_session["min_light"],
+                "max_light": active_session["max_light"]
             }
             
-            # If sleeping, calculate current duration
-            if active_session:
-                start_time = datetime.strptime(active_session[0], "%Y-%m-%d %H:%M:%S")
-                current_duration = (datetime.now() - start_time).total_seconds() / 60
-                data["current_sleep_duration"] = round(current_duration)
-                
-            return jsonify(data)
-        
-        return jsonify({"message": "No data available"})
+        return data
+    
+    return {"message": "No data available"}
+
+def acquire_long_request():
+    """Takes one of the MAX_LONG_REQUESTS slots, or returns False when they are all in use."""
+    global _long_requests
+    with _long_requests_lock:
+        if _long_requests >= app.config["MAX_LONG_REQUESTS"]:
+            metrics.LONG_REQUESTS_REJECTED.inc()
+            return False
+        _long_requests += 1
+        return True
+
+def release_long_request():
+    global _long_requests
+    with _long_requests_lock:
+        _long_requests -= 1
+
+def too_many_long_requests():
+    return jsonify({"error": "Too many open streams, retry later"}), 503, {"Retry-After": str(LONG_REQUEST_RETRY_AFTER)}
+
+@app.route("/api/stream", methods=["GET"])
+def stream():
+    """Server-sent events: the current reading, then every reading, session change and condition change as it happens."""
+    room = get_room()
+    state = get_state(room)
+    if not acquire_long_request():
+        return too_many_long_requests()
+    subscription = events.subscribe(room)
+    initial = [("reading", current_data_payload(state)), ("conditions", optimal_conditions_payload(state))]
+    
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            for event, data in initial:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            
+            shared = app.config["SHARED_STATE"]
+            last_sent = time.monotonic()
+            while True:
+                try:
+                    event, data = subscription.get(timeout=SHARED_STATE_POLL_INTERVAL if shared else STREAM_KEEPALIVE)
+                except queue.Empty:
+                    # Dropped for falling behind; end the stream so the browser reconnects and resyncs
+                    if subscription not in events.subscribers:
+                        return
+                    if shared:
+                        # Readings stored by other workers never reach this worker's broker directly
+                        result = refresh_shared_state(room, state)
+                        if result:
+                            publish_updates(room, result)
+                            continue
+                        if time.monotonic() - last_sent < STREAM_KEEPALIVE:
+                            continue
+                    yield ": keepalive\n\n"
+                    last_sent = time.monotonic()
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                last_sent = time.monotonic()
+        finally:
+            events.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    # Runs even when the client leaves before the generator starts
+    response.call_on_close(release_long_request)
+    return response
+
+def parse_query_time(value, default):
+    """Accepts epoch seconds or an ISO date/datetime such as 2025-01-31 or 2025-01-31 22:00:00."""
+    if not value:
+        return default
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        return timestamps.parse(value)
+
+@app.route("/api/sensor-history", methods=["GET"])
+def get_sensor_history():
+    """Sensor readings between `from` and `to`, raw or averaged per `bucket`, streamed page by page.
+    
+    Pass the returned `next` value back as `after` to continue where a page stopped.
+    With deadband compression, `step` is true: each raw point holds until the next, and
+    the first page starts with the value that was in effect at `from`.
+    """
+    try:
+        end = parse_query_time(request.args.get("to"), datetime.now())
+        start = parse_query_time(request.args.get("from"), end - timedelta(days=1))
+    except ValueError:
+        return jsonify({"error": "Invalid time range"}), 400
+    
+    bucket = request.args.get("bucket", "auto")
+    if bucket == "auto":
+        bucket = rollups.pick_bucket(start, end)
+    if bucket not in rollups.BUCKETS:
+        return jsonify({"error": f"Unknown bucket, use one of: auto, {', '.join(rollups.BUCKETS)}"}), 400
+    size = rollups.BUCKETS[bucket]
+    limit = max(1, min(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), HISTORY_MAX_PAGE_SIZE))
+    after = request.args.get("after")
+    
+    start_ms = timestamps.to_ms(start)
+    end_ms = timestamps.to_ms(end)
+    utc_offset = timestamps.utc_offset_ms(start)
+    try:
+        if size:
+            # Align to bucket boundaries the same way iter_buckets groups the rollups;
+            # the cursor of a bucketed page is the last bucket it returned
+            start_ms = (start_ms + utc_offset) // (size * 1000) * (size * 1000) - utc_offset
+            if after:
+                start_ms = max(start_ms, timestamps.to_ms(parse_query_time(after, start)) + size * 1000)
+        elif after:
+            after_timestamp, _, after_id = after.rpartition("|")
+            after = (int(after_timestamp), int(after_id or 0))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    
+    path = room_db_path(get_room())
+    step = app.config["DEADBAND"]
+    minute_retention_days = app.config["MINUTE_ROLLUP_RETENTION_DAYS"]
+    minute_since = rollups.minute_rollup_start(minute_retention_days) if minute_retention_days else None
+    
+    def generate():
+        # Streaming outlives the request context, so this holds its own pooled connection
+        with pooled_db(path) as conn:
+            if size:
+                rows = rollups.iter_buckets(conn, size, start_ms, end_ms, limit + 1, utc_offset, minute_since)
+            else:
+                rows = rollups.iter_raw(conn, start_ms, end_ms, after, limit + 1)
+            
+            yield (f'{{"bucket": {json.dumps(bucket)}, "from": "{timestamps.format_ms(start_ms)}", '
+                   f'"to": "{timestamps.format_ms(end_ms)}", "step": {json.dumps(step)}, "points": [')
+            cursor = None
+            count = 0
+            separator = ""
+            if step and not size and not after:
+                # The row stored before the range still held at its start; it isn't a page row, so it moves no cursor
+                held = rollups.value_at(conn, start_ms)
+                if held is not None:
+                    yield json.dumps(history_point((held[0], start_ms) + tuple(held[2:]), size))
+                    separator = ","
+            for row in rows:
+                if count == limit:
+                    break
+                yield separator + json.dumps(history_point(row, size))
+                separator = ","
+                cursor = timestamps.format_ms(row[0]) if size else f"{row[1]}|{row[0]}"
+                count += 1
+            else:
+                cursor = None
+            yield f'], "count": {count}, "next": {json.dumps(cursor)}}}'
+    
+    return Response(generate(), mimetype="application/json")
+
+@app.route("/api/export", methods=["GET"])
+def export_sensor_data():
+    """Sensor readings between `from` and `to` (all of them by default) as a tar of one .npy file per column.
+    
+    Load the download with archive.load_archive, which memory-maps the columns in place.
+    """
+    try:
+        end = parse_query_time(request.args.get("to"), datetime.now())
+        start = parse_query_time(request.args.get("from"), datetime.fromtimestamp(0))
+    except ValueError:
+        return jsonify({"error": "Invalid time range"}), 400
+    
+    start_ms = timestamps.to_ms(start)
+    end_ms = timestamps.to_ms(end)
+    room = get_room()
+    path = room_db_path(room)
+    
+    def generate():
+        # Streaming outlives the request context, so this holds its own pooled connection
+        with pooled_db(path) as conn:
+            yield from archive.iter_archive_tar(conn, start_ms, end_ms, room)
+    
+    filename = f"sensor-data-{room}-{start:%Y%m%d}-{end:%Y%m%d}.tar"
+    return Response(generate(), mimetype="application/x-tar",
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+def history_point(row, size):
+    if not size:
+        return {"timestamp": timestamps.format_ms(row[1]), "temperature": row[2], "light": row[3], "pressure": row[4]}
+    
+    count = row[1]
+    point = {"timestamp": timestamps.format_ms(row[0]), "count": count}
+    weights = 2 + len(rollups.METRICS) * 3
+    for index, metric in enumerate(rollups.METRICS):
+        total, low, high = row[2 + index * 3:5 + index * 3]
+        seconds, weighted = row[weights + index * 2:weights + 2 + index * 2]
+        # Time-weighted where the rollups know how long each value held, a plain mean otherwise
+        if seconds:
+            point[metric] = round(weighted / seconds, 2)
+        else:
+            point[metric] = round(total / count, 2) if count else None
+        point[f"{metric}_min"] = low
+        point[f"{metric}_max"] = high
+    return point
 
 @app.route("/api/sleep-history", methods=["GET"])
 def get_sleep_history():
@@ -237,112 +785,86 @@ def get_sleep_history():
     days = request.args.get('days', 7, type=int)
     start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
     
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                start_time, 
-                end_time, 
-                duration_minutes, 
-                avg_temperature, 
-                avg_light, 
-                quality 
-            FROM sleep_sessions 
-            WHERE start_time >= ? AND end_time IS NOT NULL
-            ORDER BY start_time DESC
-        """, (start_date,))
-        
-        rows = cursor.fetchall()
-        history = []
-        
-        for row in rows:
-            start_time = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")
-            end_time = datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S")
-            
-            history.append({
-                "date": start_time.strftime("%Y-%m-%d"),
-                "start_time": start_time.strftime("%H:%M"),
-                "end_time": end_time.strftime("%H:%M"),
-                "hours": round(row[2] / 60, 1),
-                "temp": row[3],
-                "light": row[4],
-                "quality": row[5]
-            })
-        
-        return jsonify(history)
+    room = get_room()
+    state = get_state(room)
+    history = state.cached_summary(("history", start_date), lambda: summaries.history(get_db(room), start_date))
+    return jsonify(history)
 
 @app.route("/api/sleep-stats", methods=["GET"])
 def get_sleep_stats():
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        
-        # Get daily averages for the past 7 days
-        cursor.execute("""
-            SELECT 
-                strftime('%Y-%m-%d', start_time) as date,
-                SUM(duration_minutes) / 60.0 as total_hours,
-                AVG(avg_temperature) as avg_temp,
-                AVG(avg_light) as avg_light
-            FROM sleep_sessions 
-            WHERE start_time >= date('now', '-7 days') AND end_time IS NOT NULL
-            GROUP BY date
-            ORDER BY date
-        """)
-        
-        daily_rows = cursor.fetchall()
-        daily_stats = []
-        
-        for row in daily_rows:
-            daily_stats.append({
-                "date": row[0],
-                "hours": round(row[1], 1),
-                "temp": round(row[2], 1) if row[2] else None,
-                "light": round(row[3], 1) if row[3] else None
-            })
-        
-        # Get weekly averages
-        cursor.execute("""
-            SELECT 
-                AVG(duration_minutes) / 60.0 as avg_hours,
-                AVG(avg_temperature) as avg_temp,
-                AVG(avg_light) as avg_light,
-                COUNT(*) as session_count
-            FROM sleep_sessions 
-            WHERE start_time >= date('now', '-7 days') AND end_time IS NOT NULL
-        """)
-        
-        weekly_row = cursor.fetchone()
-        weekly_stats = {
-            "avg_hours": round(weekly_row[0], 1) if weekly_row[0] else 0,
-            "avg_temp": round(weekly_row[1], 1) if weekly_row[1] else 0,
-            "avg_light": round(weekly_row[2], 1) if weekly_row[2] else 0,
-            "session_count": weekly_row[3]
-        }
-        
-        return jsonify({
-            "daily": daily_stats,
-            "weekly": weekly_stats
-        })
+    """Daily totals and weekly averages for the past 7 days."""
+    start_date = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+    
+    room = get_room()
+    state = get_state(room)
+    stats = state.cached_summary(("stats", start_date), lambda: summaries.stats(get_db(room), start_date))
+    return jsonify(stats)
+
+@app.route("/api/sleep-sessions/rescore", methods=["POST"])
+def rescore_sleep_sessions():
+    """Re-scores every room's finished sessions; a JSON body of thresholds replaces the current ones first."""
+    data = request.get_json(silent=True)
+    if data:
+        try:
+            thresholds = scoring.merge_thresholds(scoring_thresholds(), data)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid thresholds: {e}"}), 400
+        app.config["SCORING_THRESHOLDS"] = thresholds
+        if app.config["SHARED_STATE"]:
+            with pooled_db(app.config["DATABASE"]) as conn, conn:
+                conn.execute("UPDATE worker_state SET scoring_thresholds = ?", (json.dumps(thresholds),))
+    
+    # The thresholds apply to every room, so every room's sessions are re-scored
+    thresholds = scoring_thresholds()
+    rooms = {}
+    for room in database.list_rooms(app.config["DATABASE"]):
+        scored, changed = scoring.rescore_sessions(get_db(room), thresholds)
+        if changed:
+            get_state(room).invalidate_summaries()
+        rooms[room] = {"scored": scored, "changed": changed}
+    return jsonify({
+        "message": "Sleep sessions re-scored",
+        "scored": sum(counts["scored"] for counts in rooms.values()),
+        "changed": sum(counts["changed"] for counts in rooms.values()),
+        "rooms": rooms
+    })
 
 @app.route("/api/preferences", methods=["GET"])
 def get_preferences():
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM user_preferences ORDER BY id DESC LIMIT 1")
-        row = cursor.fetchone()
-        
-        if row:
-            return jsonify({
-                "ideal_temp": row[1],
-                "max_light": row[2],
-                "adaptive_light": bool(row[3]),
-                "auto_temp": bool(row[4]),
-                "sleep_notifications": bool(row[5]),
-                "sound_id": row[6],
-                "sound_duration": row[7]
-            })
-        
-        return jsonify({"message": "No preferences found"})
+    state = get_state(get_room())
+    if state.preferences:
+        return cached_json(state.preferences, state)
+    
+    return cached_json({"message": "No preferences found"}, state)
+
+@app.route("/api/preferences/changes", methods=["GET"])
+def wait_for_preference_changes():
+    """Long-poll: answers as soon as the preferences version differs from `version`, or after `timeout` seconds."""
+    version = request.args.get("version", 0, type=int)
+    timeout = min(request.args.get("timeout", PREFERENCES_WAIT_TIMEOUT, type=float), PREFERENCES_WAIT_TIMEOUT)
+    
+    room = get_room()
+    state = get_state(room)
+    if not acquire_long_request():
+        return too_many_long_requests()
+    try:
+        if not app.config["SHARED_STATE"]:
+            preferences = state.wait_for_preferences(version, timeout)
+        else:
+            # A change saved by another worker only shows up once we look for it
+            deadline = time.monotonic() + timeout
+            while True:
+                preferences = state.wait_for_preferences(version, max(min(deadline - time.monotonic(), SHARED_STATE_POLL_INTERVAL), 0))
+                if time.monotonic() >= deadline or (preferences and preferences["version"] != version):
+                    break
+                refresh_shared_state(room, state)
+    finally:
+        release_long_request()
+    if preferences is None:
+        return jsonify({"message": "No preferences found"}), 404
+    if preferences["version"] == version:
+        return "", 304
+    return jsonify(preferences)
 
 @app.route("/api/preferences/sound", methods=["POST"])
 def save_sound_preferences():
@@ -351,14 +873,16 @@ def save_sound_preferences():
     if not data:
         return jsonify({"error": "Invalid data"}), 400
     
-    with sqlite3.connect("smart_bedroom.db") as conn:
+    room = get_room(data)
+    with get_db(room) as conn:
         cursor = conn.cursor()
         cursor.execute("""
             UPDATE user_preferences 
-            SET sound_id = ?, sound_duration = ?
+            SET sound_id = ?, sound_duration = ?, version = version + 1
             WHERE id = (SELECT id FROM user_preferences ORDER BY id DESC LIMIT 1)
         """, (data.get("soundId"), data.get("duration")))
         conn.commit()
+        get_state(room).load_preferences(conn)
     
     return jsonify({"message": "Sound preferences saved successfully"})
 
@@ -368,11 +892,13 @@ def save_environment_preferences():
     if not data:
         return jsonify({"error": "Invalid data"}), 400
     
-    with sqlite3.connect("smart_bedroom.db") as conn:
+    room = get_room(data)
+    with get_db(room) as conn:
         cursor = conn.cursor()
         cursor.execute("""
             UPDATE user_preferences 
-            SET ideal_temp = ?, max_light = ?, adaptive_light = ?, auto_temp = ?, sleep_notifications = ?
+            SET ideal_temp = ?, max_light = ?, adaptive_light = ?, auto_temp = ?, sleep_notifications = ?,
+                version = version + 1
             WHERE id = (SELECT id FROM user_preferences ORDER BY id DESC LIMIT 1)
         """, (
             data.get("idealTemp"), 
@@ -382,38 +908,36 @@ def save_environment_preferences():
             1 if data.get("sleepNotifications") else 0
         ))
         conn.commit()
+        get_state(room).load_preferences(conn)
     
+    publish_updates(room, {"session_started": False, "session_ended": False})
     return jsonify({"message": "Environment preferences saved successfully"})
 
 @app.route("/api/optimal-conditions", methods=["GET"])
 def get_optimal_conditions():
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        
-        # Get latest sensor data
-        cursor.execute("SELECT temperature, light FROM sensor_data ORDER BY id DESC LIMIT 1")
-        sensor_row = cursor.fetchone()
-        
-        # Get user preferences
-        cursor.execute("SELECT ideal_temp, max_light FROM user_preferences ORDER BY id DESC LIMIT 1")
-        pref_row = cursor.fetchone()
-        
-        if sensor_row and pref_row:
-            temp = sensor_row[0]
-            light = sensor_row[1]
-            ideal_temp = pref_row[0]
-            max_light = pref_row[1]
-            
-            temp_optimal = (ideal_temp - 2) <= temp <= (ideal_temp + 2)
-            light_optimal = light <= max_light
-            
-            return jsonify({
-                "temperature_optimal": temp_optimal,
-                "light_optimal": light_optimal,
-                "overall_optimal": temp_optimal and light_optimal
-            })
-        
-        return jsonify({"message": "Insufficient data to determine optimal conditions"})
+    state = get_state(get_room())
+    return cached_json(optimal_conditions_payload(state), state)
+
+def optimal_conditions_payload(state):
+    sensor_row = state.reading
+    pref_row = state.preferences
+    
+    if sensor_row and pref_row:
+        temp = sensor_row["temperature"]
+        light = sensor_row["light"]
+        ideal_temp = pref_row["ideal_temp"]
+        max_light = pref_row["max_light"]
+        
+        temp_optimal = (ideal_temp - 2) <= temp <= (ideal_temp + 2)
+        light_optimal = light <= max_light
+        
+        return {
+            "temperature_optimal": temp_optimal,
+            "light_optimal": light_optimal,
+            "overall_optimal": temp_optimal and light_optimal
+        }
+    
+    return {"message": "Insufficient data to determine optimal conditions"}
 
 # def get_environment_adjustments():
 #     """Determines what environmental adjustments are needed based on preferences."""
@@ -468,28 +992,24 @@ def get_optimal_conditions():
 
 @app.route("/api/environment-control", methods=["GET"])
 def environment_control():
-    with sqlite3.connect("smart_bedroom.db") as conn:
-        cursor = conn.cursor()
-        
-        # Get user preferences
-        cursor.execute("SELECT ideal_temp, max_light, adaptive_light, auto_temp FROM user_preferences ORDER BY id DESC LIMIT 1")
-        pref_row = cursor.fetchone()
-        
-        if pref_row:
-            return jsonify({
-                    "ideal_temp": pref_row[0],
-                    "max_light": pref_row[1],
-                    "adaptive_light": bool(pref_row[2]),
-                    "auto_temp": bool(pref_row[3])
-            })
-        
-        # Default values
-        return jsonify({
-            "ideal_temp": 18.5,
-            "max_light": 20,
-            "adaptive_light": True,
-            "auto_temp": True
-        })
+    state = get_state(get_room())
+    pref_row = state.preferences
+    
+    if pref_row:
+        return cached_json({
+                "ideal_temp": pref_row["ideal_temp"],
+                "max_light": pref_row["max_light"],
+                "adaptive_light": pref_row["adaptive_light"],
+                "auto_temp": pref_row["auto_temp"]
+        }, state)
+    
+    # Default values
+    return cached_json({
+        "ideal_temp": 18.5,
+        "max_light": 20,
+        "adaptive_light": True,
+        "auto_temp": True
+    }, state)
 
 
 if __name__ == "__main__":
@@ -497,4 +1017,7 @@ if __name__ == "__main__":
         if not os.path.exists(directory):
             os.makedirs(directory)
     
+    init_db()
+    # Turn SIGTERM into a normal exit so queued readings are flushed on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=True)
\ No newline at end of file
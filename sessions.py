@@ -0,0 +1,268 @@
+import json
+import threading
+
+import scoring
+import summaries
+import timestamps
+
+# Each second is a minute (times five), so demo nights stay short
+DURATION_SCALE = 5
+
+
+def session_averages(sample_count, temp_sum, light_sum):
+    if not sample_count:
+        return None, None
+    return temp_sum / sample_count, light_sum / sample_count
+
+
+def _seconds(since, until):
+    # Both epoch ms, so a daylight saving change in between doesn't shift the result
+    return (until - since) / 1000
+
+
+def _new_session(session_id, start_time):
+    return {
+        "id": session_id,
+        "start_time": start_time,
+        "sample_count": 0,
+        "temp_sum": 0,
+        "light_sum": 0,
+        "min_temperature": None,
+        "max_temperature": None,
+        "min_light": None,
+        "max_light": None,
+    }
+
+
+class SessionDetector:
+    """Decides from the stream of pressure readings when someone got into and out of bed.
+
+    One per room, kept in memory; the database is only written when a session opens
+    or closes. The bed has to stay occupied for `start_delay` seconds before a session
+    opens and empty for `end_delay` seconds before it closes, so a single noisy reading
+    changes nothing. Both transitions are dated to the reading where the change began,
+    and sessions shorter than `min_duration` seconds are deleted instead of recorded.
+    Every time it keeps is epoch ms, like the stored ones.
+    """
+
+    def __init__(self, start_delay=0, end_delay=0, min_duration=0, thresholds=None):
+        self.start_delay = start_delay
+        self.end_delay = end_delay
+        self.min_duration = min_duration
+        # Read when a session closes, so rescoring with new thresholds also applies to the next one
+        self.thresholds = thresholds or (lambda: scoring.DEFAULT_THRESHOLDS)
+        # Held by the ingestion transaction, so readings are fed in commit order
+        self.lock = threading.Lock()
+        self.session = None
+        # In-bed readings waiting out start_delay, as (time, reading)
+        self.pending = []
+        # Time of the first empty-bed reading while a session is open
+        self.empty_since = None
+        # Time of the newest reading observed; older ones arriving late can't cause transitions
+        self.latest = None
+        # worker_state version this detector's state matches, and the state last saved there
+        self.version = None
+        self.saved = None
+
+    def snapshot(self):
+        """The open session with its running sums and extremes, or None."""
+        return dict(self.session) if self.session else None
+
+    def observe(self, conn, data, now):
+        """Feeds one reading, captured at `now` (epoch ms), and returns which transitions it caused.
+
+        A reading older than the newest one seen, e.g. replayed from a client's spool,
+        leaves the pending start and end alone; if it is an in-bed reading from inside
+        the open session it still counts towards its averages.
+        """
+        result = {"session_started": False, "session_ended": False}
+        in_bed = (data.get("pressure") or 0) > 0
+
+        if self.latest is not None and now < self.latest:
+            if in_bed and self.session is not None and now >= self.session["start_time"]:
+                self._accumulate(data)
+            return result
+        self.latest = now
+
+        if self.session is None:
+            if not in_bed:
+                self.pending = []
+            else:
+                self.pending.append((now, data))
+                if _seconds(self.pending[0][0], now) >= self.start_delay:
+                    self._open(conn)
+                    result["session_started"] = True
+            return result
+
+        if in_bed:
+            self.empty_since = None
+            self._accumulate(data)
+        else:
+            if self.empty_since is None:
+                self.empty_since = now
+            if _seconds(self.empty_since, now) >= self.end_delay:
+                self._close(conn, self.empty_since)
+                result["session_ended"] = True
+        return result
+
+    def _open(self, conn):
+        print('Comecou uma sessao')
+        start_time = self.pending[0][0]
+        cursor = conn.execute("INSERT INTO sleep_sessions (start_time) VALUES (?)", (start_time,))
+        self.session = _new_session(cursor.lastrowid, start_time)
+        for _, data in self.pending:
+            self._accumulate(data)
+        self.pending = []
+
+    def _accumulate(self, data):
+        """Folds one in-bed reading into the open session's running sums, counts and extremes."""
+        temp = data.get("temp")
+        light = data.get("light")
+        if temp is None or light is None:
+            return
+        session = self.session
+        session["sample_count"] += 1
+        session["temp_sum"] += temp
+        session["light_sum"] += light
+        session["min_temperature"] = temp if session["min_temperature"] is None else min(session["min_temperature"], temp)
+        session["max_temperature"] = temp if session["max_temperature"] is None else max(session["max_temperature"], temp)
+        session["min_light"] = light if session["min_light"] is None else min(session["min_light"], light)
+        session["max_light"] = light if session["max_light"] is None else max(session["max_light"], light)
+
+    def _close(self, conn, end_time):
+        session = self.session
+        self.session = None
+        self.empty_since = None
+        start_time = session["start_time"]
+        end_time = max(end_time, start_time)
+        seconds = _seconds(start_time, end_time)
+
+        if seconds < self.min_duration:
+            print(f"Discarded a {seconds:.0f}s sleep session, shorter than the {self.min_duration:g}s minimum")
+            conn.execute("DELETE FROM sleep_sessions WHERE id = ?", (session["id"],))
+            return
+
+        print('acabou uma sessao')
+        duration = seconds * DURATION_SCALE
+        avg_temp, avg_light = session_averages(session["sample_count"], session["temp_sum"], session["light_sum"])
+        if avg_temp is not None and avg_light is not None:
+            quality = scoring.determine_sleep_quality(avg_temp, avg_light, duration, self.thresholds())
+        else:
+            quality = scoring.UNKNOWN
+
+        conn.execute("""
+            UPDATE sleep_sessions
+            SET end_time = ?, duration_minutes = ?, avg_temperature = ?, avg_light = ?, quality = ?,
+                sample_count = ?, temp_sum = ?, light_sum = ?,
+                min_temperature = ?, max_temperature = ?, min_light = ?, max_light = ?
+            WHERE id = ?
+        """, (end_time, round(duration), avg_temp, avg_light, quality,
+              session["sample_count"], session["temp_sum"], session["light_sum"],
+              session["min_temperature"], session["max_temperature"], session["min_light"], session["max_light"],
+              session["id"]))
+        summaries.refresh_day(conn, timestamps.from_ms(start_time).strftime(timestamps.DATE_FORMAT))
+        summaries.mark_changed(conn)
+
+    def _state(self):
+        return json.dumps({
+            "session": self.session,
+            "pending": [(time, {key: data.get(key) for key in ("temp", "light", "pressure")})
+                        for time, data in self.pending],
+            "empty_since": self.empty_since,
+            "latest": self.latest,
+        })
+
+    def _restore(self, state):
+        state = json.loads(state)
+        self.session = state["session"]
+        self.pending = [(time, data) for time, data in state["pending"]]
+        self.empty_since = state["empty_since"]
+        self.latest = state.get("latest")
+
+    def sync(self, conn):
+        """Adopts the state another worker process saved since this one last looked.
+
+        Only needed when several processes write to the same database; call it and
+        save inside the same immediate transaction as the readings.
+        """
+        version, state = conn.execute("SELECT detector_version, detector FROM worker_state").fetchone()
+        if version != self.version and state:
+            self._restore(state)
+            self.saved = state
+        self.version = version
+
+    def save(self, conn):
+        """Publishes this detector's state to the other worker processes, if it changed."""
+        state = self._state()
+        if state == self.saved:
+            return
+        conn.execute("""
+            UPDATE worker_state
+            SET detector_version = detector_version + 1, detector = ?, last_reading_id = (SELECT MAX(id) FROM sensor_data)
+        """, (state,))
+        self.version = conn.execute("SELECT detector_version FROM worker_state").fetchone()[0]
+        self.saved = state
+
+    def resume(self, conn):
+        """Like rebuild, but starts from the state other workers saved when it covers every stored reading."""
+        version, state, last_reading_id = conn.execute(
+            "SELECT detector_version, detector, last_reading_id FROM worker_state").fetchone()
+        if state and last_reading_id == conn.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0]:
+            self._restore(state)
+            self.version, self.saved = version, state
+            return
+        self.rebuild(conn)
+        self.save(conn)
+
+    def rebuild(self, conn):
+        """Restores the detector from the database, e.g. after a restart; the caller commits.
+
+        The readings stored since the open session began are replayed, which restores
+        its running sums and closes it if the bed went empty while the server was down.
+        Any older open sessions left behind by a crash are closed where their readings
+        say the bed emptied, or where the next session began.
+        """
+        self.session, self.pending, self.empty_since, self.latest = None, [], None, None
+        open_sessions = conn.execute(
+            "SELECT id, start_time FROM sleep_sessions WHERE end_time IS NULL ORDER BY start_time, id").fetchall()
+
+        if not open_sessions:
+            # Only the trailing run of in-bed readings can still be waiting to open a session
+            run = []
+            for row in conn.execute("SELECT timestamp, temperature, light, pressure FROM sensor_data ORDER BY timestamp DESC, id DESC"):
+                if not (row[3] or 0) > 0:
+                    break
+                run.append(row)
+            self._replay(conn, reversed(run))
+            return
+
+        for (session_id, start_time), following in zip(open_sessions, open_sessions[1:] + [None]):
+            self.session, self.empty_since = _new_session(session_id, start_time), None
+            if following is None:
+                self._replay(conn, self._readings(conn, start_time, None))
+                continue
+
+            self._replay(conn, self._readings(conn, start_time, following[1]), until_closed=True)
+            if self.session is not None:
+                self._close(conn, self.empty_since or following[1])
+            self.pending = []
+        if open_sessions[1:]:
+            print(f"Closed {len(open_sessions) - 1} sleep sessions left open by an earlier run")
+
+    def _replay(self, conn, rows, until_closed=False):
+        for timestamp, temperature, light, pressure in rows:
+            self.observe(conn, {"temp": temperature, "light": light, "pressure": pressure}, timestamp)
+            if until_closed and self.session is None:
+                break
+
+    @staticmethod
+    def _readings(conn, start_time, end_time):
+        if end_time is None:
+            return conn.execute("""
+                SELECT timestamp, temperature, light, pressure FROM sensor_data
+                WHERE timestamp >= ? ORDER BY timestamp, id
+            """, (start_time,))
+        return conn.execute("""
+            SELECT timestamp, temperature, light, pressure FROM sensor_data
+            WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp, id
+        """, (start_time, end_time))
@@ -0,0 +1,153 @@
+import queue
+import threading
+from datetime import datetime, timezone
+
+import timestamps
+
+
+class LatestState:
+    """Latest reading, open sleep session and preferences, kept in memory for the dashboard endpoints.
+
+    The ingestion and preference routes update it right after they commit, so read
+    endpoints never have to touch the database to answer a poll.
+    """
+
+    MAX_CACHED_SUMMARIES = 64
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.reading = None
+        # Row id of the reading loaded from the database, and the summaries version the cache
+        # matches; both let a worker notice what other worker processes wrote
+        self.reading_id = None
+        # Epoch ms of the cached reading, so one that arrives late can't replace a newer one
+        self.reading_time = None
+        self.summaries_version = None
+        self.session = None
+        self.preferences = None
+        self.preferences_version = 0
+        self.preferences_changed = threading.Condition()
+        self.last_modified = datetime.now(timezone.utc)
+        # Sleep history and stats payloads, which only change when a session ends
+        self.summaries = {}
+
+    def ensure_loaded(self, get_conn):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            conn = get_conn()
+            self.load_reading(conn)
+            self.load_preferences(conn)
+            self.loaded = True
+
+    def touch(self):
+        self.last_modified = datetime.now(timezone.utc)
+
+    def load_reading(self, conn):
+        row = conn.execute("""
+            SELECT (SELECT MAX(id) FROM sensor_data), temperature, light, pressure, timestamp
+            FROM sensor_data ORDER BY timestamp DESC, id DESC LIMIT 1
+        """).fetchone()
+        self.reading_time = None
+        if row:
+            self.set_reading(*row[1:], reading_id=row[0])
+        else:
+            self.reading_id, self.reading = None, None
+            self.touch()
+
+    def set_reading(self, temperature, light, pressure, timestamp, reading_id=None):
+        """Makes this the latest reading unless the cached one is newer; returns whether it did.
+
+        `timestamp` is epoch ms, kept the way the API shows it.
+        """
+        self.reading_id = reading_id
+        if self.reading_time is not None and timestamp < self.reading_time:
+            return False
+        self.reading_time = timestamp
+        self.reading = {
+            "temperature": temperature,
+            "light": light,
+            "pressure": pressure,
+            "timestamp": timestamps.format_ms(timestamp)
+        }
+        self.touch()
+        return True
+
+    def set_session(self, session):
+        # Comes from the room's session detector rather than the database
+        self.session = session
+        self.touch()
+
+    def cached_summary(self, key, compute):
+        payload = self.summaries.get(key)
+        if payload is None:
+            if len(self.summaries) >= self.MAX_CACHED_SUMMARIES:
+                self.summaries = {}
+            payload = self.summaries[key] = compute()
+        return payload
+
+    def invalidate_summaries(self):
+        self.summaries = {}
+
+    def load_preferences(self, conn):
+        row = conn.execute("""
+            SELECT ideal_temp, max_light, adaptive_light, auto_temp, sleep_notifications,
+                   sound_id, sound_duration, version
+            FROM user_preferences ORDER BY id DESC LIMIT 1
+        """).fetchone()
+        with self.preferences_changed:
+            if row:
+                self.preferences = {
+                    "ideal_temp": row[0],
+                    "max_light": row[1],
+                    "adaptive_light": bool(row[2]),
+                    "auto_temp": bool(row[3]),
+                    "sleep_notifications": bool(row[4]),
+                    "sound_id": row[5],
+                    "sound_duration": row[6],
+                    "version": row[7]
+                }
+                self.preferences_version = row[7]
+            else:
+                self.preferences = None
+            self.touch()
+            self.preferences_changed.notify_all()
+
+    def wait_for_preferences(self, version, timeout):
+        """Blocks until the preferences version differs from the one the caller has, or the timeout passes."""
+        with self.preferences_changed:
+            self.preferences_changed.wait_for(lambda: self.preferences_version != version, timeout)
+            return self.preferences
+
+
+class EventBroker:
+    """Fans out server-sent events to every connected dashboard stream."""
+
+    def __init__(self, max_pending=100):
+        self.lock = threading.Lock()
+        self.max_pending = max_pending
+        # Each subscriber's queue, mapped to the room it is watching
+        self.subscribers = {}
+
+    def subscribe(self, room):
+        events = queue.Queue(maxsize=self.max_pending)
+        with self.lock:
+            self.subscribers[events] = room
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.pop(events, None)
+
+    def publish(self, event, data, room):
+        with self.lock:
+            subscribers = [events for events, watched in self.subscribers.items() if watched == room]
+        for events in subscribers:
+            try:
+                events.put_nowait((event, data))
+            except queue.Full:
+                # A stalled client shouldn't hold up ingestion; it will resync on reconnect
+                self.unsubscribe(events)
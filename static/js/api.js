@@ -1,7 +1,17 @@
 
+// Adds the room from the page URL (?room=...) to an API path, if one was given
+export function withRoom(endpoint) {
+    const room = new URLSearchParams(window.location.search).get('room');
+    if (!room) {
+        return endpoint;
+    }
+    const separator = endpoint.includes('?') ? '&' : '?';
+    return `${endpoint}${separator}room=${encodeURIComponent(room)}`;
+}
+
 // Generic function to fetch data from API
 export function fetchFromAPI(endpoint) {
-    return fetch(endpoint)
+    return fetch(withRoom(endpoint))
         .then(response => {
             if (!response.ok) {
                 throw new Error(`API error: ${response.status}`);
@@ -14,7 +24,7 @@ export function fetchFromAPI(endpoint) {
 export function saveSoundPreferences(data) {
     console.log('Saving sound preferences:', data);
     
-    return fetch('/api/preferences/sound', {
+    return fetch(withRoom('/api/preferences/sound'), {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
@@ -47,7 +57,7 @@ export function saveSoundPreferences(data) {
 export function saveEnvironmentPreferences(data) {
     console.log('Saving environment preferences:', data);
     
-    return fetch('/api/preferences/environment', {
+    return fetch(withRoom('/api/preferences/environment'), {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
@@ -1,5 +1,5 @@
 // Dashboard initialization and updates
-import { fetchFromAPI } from './api.js';
+import { fetchFromAPI, withRoom } from './api.js';
 import { playSound } from './audio-player.js';
 
 export function initDashboard() {
@@ -9,8 +9,58 @@ export function initDashboard() {
 
     addSleepModeButton();
     
-    // Update every 5 seconds
-    setInterval(fetchCurrentData, 5000);
+    // Get live updates pushed from the server, polling only while the stream is down
+    connectToStream();
+}
+
+let pollingInterval = null;
+// Milliseconds to wait before reopening a stream the server turned away
+const STREAM_RECONNECT_DELAY = 30000;
+
+function startPolling() {
+    if (pollingInterval === null) {
+        // Update every 5 seconds
+        pollingInterval = setInterval(fetchCurrentData, 5000);
+    }
+}
+
+function stopPolling() {
+    if (pollingInterval !== null) {
+        clearInterval(pollingInterval);
+        pollingInterval = null;
+    }
+}
+
+function connectToStream() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const source = new EventSource(withRoom('/api/stream'));
+
+    source.addEventListener('open', stopPolling);
+    source.addEventListener('error', () => {
+        // The browser keeps retrying the stream on its own; poll in the meantime
+        console.error('Live update stream disconnected, falling back to polling');
+        startPolling();
+        // Except after an error status such as the 503 for too many open streams
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(connectToStream, STREAM_RECONNECT_DELAY);
+        }
+    });
+
+    source.addEventListener('reading', event => {
+        handleCurrentData(JSON.parse(event.data));
+    });
+
+    source.addEventListener('session', event => {
+        const session = JSON.parse(event.data);
+        console.log('Sleep session ' + session.event);
+        if (session.event === 'ended') {
+            populateSleepHistoryTable();
+        }
+    });
 }
 
 function addSleepModeButton() {
@@ -61,29 +111,31 @@ function stopSoundImport() {
 
 function fetchCurrentData() {
     fetchFromAPI('/api/current-data')
-        .then(data => {
-            updateDashboardStats(data);
-
-            if (window.sleepModeEnabled) {
-                // Check if a sleep session has started
-                if (data.sleeping && !window.previousSleepingState) {
-                    console.log('Sleep session detected - playing sleep sound');
-                    playSleepSound();
-                }
-                // Check if a sleep session has ended
-                else if (!data.sleeping && window.previousSleepingState) {
-                    console.log('Sleep session ended - stopping sound');
-                    stopSoundImport();
-                }
-            }
-
-            window.previousSleepingState = data.sleeping;
-        })
+        .then(handleCurrentData)
         .catch(error => {
             console.error('Error fetching sensor data:', error);
         });
 }
 
+function handleCurrentData(data) {
+    updateDashboardStats(data);
+
+    if (window.sleepModeEnabled) {
+        // Check if a sleep session has started
+        if (data.sleeping && !window.previousSleepingState) {
+            console.log('Sleep session detected - playing sleep sound');
+            playSleepSound();
+        }
+        // Check if a sleep session has ended
+        else if (!data.sleeping && window.previousSleepingState) {
+            console.log('Sleep session ended - stopping sound');
+            stopSoundImport();
+        }
+    }
+
+    window.previousSleepingState = data.sleeping;
+}
+
 // Check if it's time to play sleep sounds
 function playSleepSound() {
     // Get the user's preferred sound settings
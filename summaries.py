@@ -0,0 +1,100 @@
+import json
+
+import timestamps
+
+# One row per night (by session start date) of finished sleep sessions. Sums and
+# counts rather than averages, so any range of days can be averaged exactly.
+# `sessions` holds that day's entries as /api/sleep-history returns them, newest first.
+
+
+def history_entry(start_time, end_time, duration_minutes, avg_temperature, avg_light, quality):
+    # Stored as epoch ms; entries are kept formatted, so history requests never convert them
+    start, end = timestamps.from_ms(start_time), timestamps.from_ms(end_time)
+    return {
+        "date": start.strftime(timestamps.DATE_FORMAT),
+        "start_time": start.strftime("%H:%M"),
+        "end_time": end.strftime("%H:%M"),
+        "hours": round((duration_minutes or 0) / 60, 1),
+        "temp": avg_temperature,
+        "light": avg_light,
+        "quality": quality
+    }
+
+
+def refresh_day(conn, date):
+    """Recomputes one day's summary from its finished sessions; called when a session on that day ends."""
+    rows = conn.execute("""
+        SELECT start_time, end_time, duration_minutes, avg_temperature, avg_light, quality
+        FROM sleep_sessions
+        WHERE start_time >= ? AND start_time < ? AND end_time IS NOT NULL
+        ORDER BY start_time DESC
+    """, timestamps.day_range(date)).fetchall()
+
+    if not rows:
+        conn.execute("DELETE FROM daily_sleep_summary WHERE date = ?", (date,))
+        return
+
+    temps = [row[3] for row in rows if row[3] is not None]
+    lights = [row[4] for row in rows if row[4] is not None]
+    conn.execute("""
+        INSERT OR REPLACE INTO daily_sleep_summary
+        (date, session_count, total_minutes, temp_sum, temp_count, light_sum, light_count, sessions)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (date, len(rows), sum(row[2] or 0 for row in rows), sum(temps), len(temps), sum(lights), len(lights),
+          json.dumps([history_entry(*row) for row in rows])))
+
+
+def rebuild(conn):
+    """Recomputes every day's summary, e.g. after sessions were bulk loaded or re-scored."""
+    conn.execute("DELETE FROM daily_sleep_summary")
+    # Nights are local calendar days
+    dates = conn.execute("""
+        SELECT DISTINCT date(start_time / 1000, 'unixepoch', 'localtime') FROM sleep_sessions WHERE end_time IS NOT NULL
+    """).fetchall()
+    for (date,) in dates:
+        refresh_day(conn, date)
+    return len(dates)
+
+
+def mark_changed(conn):
+    # Tells other server worker processes their cached history and stats are stale
+    conn.execute("UPDATE worker_state SET summaries_version = summaries_version + 1")
+
+
+def history(conn, start_date):
+    """Finished sessions starting on or after `start_date`, newest first."""
+    rows = conn.execute("SELECT sessions FROM daily_sleep_summary WHERE date >= ? ORDER BY date DESC", (start_date,))
+    return [entry for (sessions,) in rows for entry in json.loads(sessions)]
+
+
+def stats(conn, start_date):
+    """Per-day totals and averages over the whole range, for days on or after `start_date`."""
+    rows = conn.execute("""
+        SELECT date, session_count, total_minutes, temp_sum, temp_count, light_sum, light_count
+        FROM daily_sleep_summary
+        WHERE date >= ?
+        ORDER BY date
+    """, (start_date,)).fetchall()
+
+    daily = []
+    for date, _, total_minutes, temp_sum, temp_count, light_sum, light_count in rows:
+        daily.append({
+            "date": date,
+            "hours": round(total_minutes / 60, 1),
+            "temp": round(temp_sum / temp_count, 1) if temp_sum else None,
+            "light": round(light_sum / light_count, 1) if light_sum else None
+        })
+
+    session_count = sum(row[1] for row in rows)
+    temp_count = sum(row[4] for row in rows)
+    light_count = sum(row[6] for row in rows)
+    avg_hours = sum(row[2] for row in rows) / session_count / 60 if session_count else 0
+    avg_temp = sum(row[3] for row in rows) / temp_count if temp_count else 0
+    avg_light = sum(row[5] for row in rows) / light_count if light_count else 0
+    weekly = {
+        "avg_hours": round(avg_hours, 1),
+        "avg_temp": round(avg_temp, 1),
+        "avg_light": round(avg_light, 1),
+        "session_count": session_count
+    }
+    return {"daily": daily, "weekly": weekly}
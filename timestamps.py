@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+# Times are stored as integer milliseconds since the Unix epoch (UTC) and only turned
+# into the server's local wall-clock time where the API reads or writes them
+API_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def to_ms(moment):
+    """Epoch milliseconds of a datetime; naive ones are the server's local time, as datetime.now() returns."""
+    return round(moment.timestamp() * 1000)
+
+
+def from_ms(ms):
+    """The naive local datetime of a stored time."""
+    return datetime.fromtimestamp(ms / 1000)
+
+
+def format_ms(ms):
+    """A stored time as the API shows it, with milliseconds only when there are any."""
+    if ms is None:
+        return None
+    text = from_ms(ms).strftime(API_FORMAT)
+    return text if not ms % 1000 else f"{text}.{ms % 1000:03d}"
+
+
+def parse(text):
+    """An API time string, e.g. 2025-01-31, 2025-01-31 22:00:00 or 2025-01-31 22:00:00.250, as local time."""
+    moment = datetime.fromisoformat(text)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+def utc_offset_ms(moment):
+    """How far the server's local time was ahead of UTC at a naive local datetime, in milliseconds."""
+    return round(moment.astimezone().utcoffset().total_seconds() * 1000)
+
+
+def day_range(date):
+    """Epoch milliseconds of local midnight starting a "%Y-%m-%d" day and of the next one."""
+    start = datetime.strptime(date, DATE_FORMAT)
+    return to_ms(start), to_ms(start + timedelta(days=1))
@@ -0,0 +1,114 @@
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Accepts items from request threads and hands them to `write_group` on one writer thread.
+
+    The writer takes everything that arrives within `max_delay` seconds of the first
+    waiting item, up to `max_batch` items, and writes it as one group, so many
+    requests share a single commit. Items are written in the order they were put.
+
+    Items were already acknowledged when they were queued. A group that fails with one
+    of the `transient` exceptions, e.g. on a busy database, is retried up to
+    `max_retries` times with a doubling backoff while new items wait in the queue. Any
+    other failure means something in the group can't be stored, so its items are
+    written one at a time and only the ones that still fail are dropped. `write_group`
+    may remove the items it did store from the group list, so that a retry only writes
+    the rest.
+    """
+
+    def __init__(self, write_group, max_batch=500, max_delay=0.005, max_pending=10000, on_group=None,
+                 transient=(), max_retries=10, retry_delay=0.05, max_retry_delay=5):
+        self.write_group = write_group
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.transient = transient
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_group = on_group
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        """Queues an item without blocking; raises queue.Full when the writer can't keep up."""
+        if self.closed:
+            raise queue.Full("write-behind queue is closed")
+        self.pending.put_nowait(item)
+
+    def put_many(self, items):
+        """Queues all of `items` or, when there clearly isn't room, none of them."""
+        if self.pending.maxsize - self.depth() < len(items):
+            raise queue.Full("write-behind queue is full")
+        for item in items:
+            self.put(item)
+
+    def depth(self):
+        return self.pending.qsize()
+
+    def close(self):
+        """Stops taking items, writes whatever is still queued and stops the writer."""
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(_STOP)
+        self.thread.join()
+
+    def _next_group(self):
+        first = self.pending.get()
+        if first is _STOP:
+            return None, True
+        group = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(group) < self.max_batch:
+            try:
+                item = self.pending.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return group, True
+            group.append(item)
+        return group, False
+
+    def _write(self, group):
+        try:
+            self._write_with_retries(group)
+        except Exception as e:
+            if len(group) <= 1:
+                print(f"Write-behind writer dropped {group}: {e}")
+                return
+            print(f"Write-behind writer failed to store {len(group)} items, writing them one by one: {e}")
+            for item in list(group):
+                try:
+                    self._write_with_retries([item])
+                except Exception as e:
+                    print(f"Write-behind writer dropped {item}: {e}")
+
+    def _write_with_retries(self, group):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.write_group(group)
+                return
+            except self.transient as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Write-behind writer failed to store {len(group)} items, retrying in {delay:g}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            group, stopping = self._next_group()
+            if group:
+                size = len(group)
+                self._write(group)
+                if self.on_group:
+                    self.on_group(size)
@@ -0,0 +1,19 @@
+"""Production entry point for a multi-process WSGI server, e.g.
+
+    gunicorn --workers 4 --worker-class gthread --threads 32 --bind 0.0.0.0:5000 wsgi:app
+
+Live streams and preference long-polls hold a thread each for as long as they stay open.
+Past SMART_BEDROOM_MAX_LONG_REQUESTS of them per worker (default 24) they get a 503 with
+Retry-After, so keep that below --threads to leave threads free for regular requests.
+
+Every worker process opens the same room databases, so shared state is on by default
+here; set SMART_BEDROOM_SHARED_STATE=0 when running a single process.
+"""
+import os
+
+import server
+
+server.app.config["SHARED_STATE"] = os.environ.get("SMART_BEDROOM_SHARED_STATE", "1") == "1"
+server.init_db()
+
+app = server.app